@@ -0,0 +1,278 @@
+import argparse
+import datetime
+import difflib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+import local_engine
+import stats
+import synthetic
+
+# Benchmarks of the Hail pipeline, run for every sample count, and of stats.py, run for every permutation count
+PIPELINE_BENCHMARKS = ["import", "union", "aggregation"]
+# local (main.py Readvcfs --engine local) runs for every sample count without Hail
+LOCAL_BENCHMARKS = ["local"]
+STATS_BENCHMARKS = ["permutation"]
+SAMPLE_SCALES = [10, 100, 1000]
+PERMUTATION_SCALES = [10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+# Genes of the synthetic frequency tables and of the tested gene set in the permutation benchmark
+PERMUTATION_GENES = 20000
+GENE_SET_SIZE = 20
+# A result slower than its baseline by more than this fraction is a regression
+TOLERANCE = 0.2
+
+
+def _result(benchmark, scale, start, **fields):
+    seconds = (datetime.datetime.now() - start).total_seconds()
+    result = {"benchmark": benchmark, "scale": scale, "seconds": seconds}
+    result.update(fields)
+    sys.stderr.write("{0} at scale {1}: {2:.2f} s\n".format(benchmark, scale, seconds))
+    return result
+
+
+def benchmark_pipeline(samples, work_dir, benchmarks=PIPELINE_BENCHMARKS, variants=20000, sample_variants=2000,
+                       genes=500, seed=0, vep_cache=None):
+    """
+    Imports a synthetic cohort of samples VCFs with the stub VEP (import, see main.import_sample), unions the per
+    sample tables (union, see main.table_join) and aggregates the union into the frequency table (aggregation, see
+    main.gnomad_table). The union and the frequency table are written so that each benchmark times its own work.
+    Later benchmarks need the earlier ones, a benchmark left out of benchmarks is run but not reported.
+    :return: list of result dicts
+    """
+    import hail as hl
+    import main
+
+    work_dir = Path(work_dir)
+    vcfs = synthetic.write_cohort(work_dir.joinpath("vcfs"), samples, variants, sample_variants, genes, seed)
+    main.VEP_CONFIG = synthetic.write_vep_config(work_dir.joinpath("vep_stub.json")).__str__()
+    dest = work_dir.joinpath("tables")
+    results = []
+
+    start = datetime.datetime.now()
+    manifest = main.ImportManifest(dest)
+    tables = [main.import_sample(manifest, vcfpath, vep_cache=vep_cache) for vcfpath in vcfs]
+    if "import" in benchmarks:
+        results.append(_result("import", samples, start, variants=variants, sample_variants=sample_variants))
+    if "union" not in benchmarks and "aggregation" not in benchmarks:
+        return results
+
+    start = datetime.datetime.now()
+    union_path = work_dir.joinpath("union.ht").__str__()
+    main.table_join(main.mts_to_table(tables)).write(union_path, overwrite=True)
+    unioned = hl.read_table(union_path)
+    if "union" in benchmarks:
+        results.append(_result("union", samples, start, partitions=unioned.n_partitions()))
+
+    start = datetime.datetime.now()
+    main.gnomad_table(unioned).write(work_dir.joinpath("gnomad_tb.ht").__str__(), overwrite=True)
+    if "aggregation" in benchmarks:
+        results.append(_result("aggregation", samples, start, genes=genes))
+    return results
+
+
+def benchmark_local(samples, work_dir, variants=20000, sample_variants=2000, genes=500, seed=0, workers=1):
+    """
+    Builds the frequency table TSV of a synthetic cohort of samples VCFs with local_engine, as main.py Readvcfs
+    --engine local does.
+    :return: result dict
+    """
+    work_dir = Path(work_dir)
+    vcfs = synthetic.write_cohort(work_dir.joinpath("vcfs"), samples, variants, sample_variants, genes, seed)
+    impacts = list(synthetic.IMPACT_WEIGHTS)
+    start = datetime.datetime.now()
+    counts = local_engine.cohort_counts(vcfs, impacts, [0.01, 0.05], workers)
+    local_engine.write_tsv(counts, work_dir.joinpath("gnomad.tsv"), impacts, synthetic.AF_BINS)
+    return _result("local", samples, start, variants=variants, sample_variants=sample_variants, workers=workers)
+
+
+def compare_engines(samples, work_dir, variants=20000, sample_variants=2000, genes=500, seed=0, vep_cache=None,
+                    workers=1):
+    """
+    Builds gnomad.tsv of a synthetic cohort of samples VCFs and of the synthetic.write_edge_case_vcf entries with both
+    Readvcfs engines, the Hail path (with the stub VEP) and --engine local, and compares the files byte for byte.
+    Every synthetic.FAILING_ROWS entry is imported alone with both as well, each engine should fail on it.
+    :return: dict of the comparison: identical, the first lines of the diff and the outcome of each engine on each
+    failing entry
+    """
+    import hail as hl
+    import main
+
+    work_dir = Path(work_dir)
+    vcfs = synthetic.write_cohort(work_dir.joinpath("vcfs"), samples, variants, sample_variants, genes, seed)
+    vcfs.append(synthetic.write_edge_case_vcf(work_dir.joinpath("vcfs", "EDGE000000.vcf")))
+    main.VEP_CONFIG = synthetic.write_vep_config(work_dir.joinpath("vep_stub.json")).__str__()
+    manifest = main.ImportManifest(work_dir.joinpath("tables"))
+    tables = [main.import_sample(manifest, vcfpath, vep_cache=vep_cache) for vcfpath in vcfs]
+    paths = {"hail": work_dir.joinpath("hail.tsv"), "local": work_dir.joinpath("local.tsv")}
+    main.gnomad_table(main.table_join(main.mts_to_table(tables))).flatten().export(paths["hail"].__str__())
+    main.write_local_gnomad_tsv(vcfs, paths["local"], workers=workers)
+    contents = {engine: path.read_bytes() for engine, path in paths.items()}
+    diff = difflib.unified_diff(contents["hail"].decode("utf-8").splitlines(),
+                                contents["local"].decode("utf-8").splitlines(), "hail", "local", lineterm="", n=0)
+
+    failing = dict()
+    for number, name in enumerate(synthetic.FAILING_ROWS):
+        failing_dir = work_dir.joinpath(name)
+        failing_dir.mkdir(parents=True, exist_ok=True)
+        sample = "FAIL{0:06d}".format(number)
+        vcfpath = synthetic.write_edge_case_vcf(failing_dir.joinpath(sample + ".vcf"), sample, name)
+        outcomes = failing[name] = dict()
+        try:
+            main.write_local_gnomad_tsv([vcfpath], failing_dir.joinpath("local.tsv"), workers=1)
+            outcomes["local"] = "imported"
+        except ValueError as e:
+            outcomes["local"] = "failed: {0}".format(e)
+        try:
+            manifest = main.ImportManifest(failing_dir.joinpath("tables"))
+            main.import_sample(manifest, vcfpath, vep_cache=vep_cache).count()
+            outcomes["hail"] = "imported"
+        except Exception as e:  # Hail raises FatalError or HailException, depending on the version
+            outcomes["hail"] = "failed: {0}".format(type(e).__name__)
+    return {"samples": samples, "identical": contents["hail"] == contents["local"], "diff": list(diff)[:40],
+            "failing": failing}
+
+
+def benchmark_permutations(iterations, genes=PERMUTATION_GENES, gene_set_size=GENE_SET_SIZE, seed=0, workers=1):
+    """
+    Monte Carlo permutations (null forced to monte-carlo) of one gene set over synthetic case and control
+    frequency tables of the default cohort sizes.
+    :return: result dict
+    """
+    df_case = synthetic.frequency_table(genes, stats.CASE_SAMPLES, seed)
+    df_control = synthetic.frequency_table(genes, stats.CONTROL_SAMPLES, seed + 1)
+    test = stats.PermutationTest.from_tables(df_case, df_control)
+    gene_set = list(df_case.gene[np.random.default_rng(seed).choice(genes, gene_set_size, replace=False)])
+    # Warm up, the first run pays for imports and allocations
+    test.run(gene_set, 1000, seed, null="monte-carlo")
+    start = datetime.datetime.now()
+    test.run(gene_set, iterations, seed, workers=workers, null="monte-carlo")
+    result = _result("permutation", iterations, start, genes=genes, gene_set_size=gene_set_size, workers=workers)
+    result["permutations_per_second"] = iterations / result["seconds"] if result["seconds"] > 0 else None
+    return result
+
+
+def run_benchmarks(benchmarks, sample_scales=SAMPLE_SCALES, permutation_scales=PERMUTATION_SCALES, work_dir=None,
+                   seed=0, workers=1, pipeline_options=None):
+    """
+    :return: dict of the run environment (created, host) and the list of results
+    """
+    results = []
+    for iterations in permutation_scales if "permutation" in benchmarks else []:
+        results.append(benchmark_permutations(iterations, seed=seed, workers=workers))
+    options = dict(pipeline_options or {})
+    for samples in sample_scales if "local" in benchmarks else []:
+        scale_dir = Path(tempfile.mkdtemp(dir=work_dir))
+        try:
+            results.append(benchmark_local(samples, scale_dir, options.get("variants", 20000),
+                                           options.get("sample_variants", 2000), options.get("genes", 500), seed,
+                                           workers))
+        finally:
+            shutil.rmtree(scale_dir, ignore_errors=True)
+    pipeline = [benchmark for benchmark in benchmarks if benchmark in PIPELINE_BENCHMARKS]
+    if len(pipeline) > 0:
+        import hail as hl
+        hl.init(min_block_size=128)
+        for samples in sample_scales:
+            scale_dir = Path(tempfile.mkdtemp(dir=work_dir))
+            try:
+                results += benchmark_pipeline(samples, scale_dir, pipeline, seed=seed, **options)
+            finally:
+                shutil.rmtree(scale_dir, ignore_errors=True)
+    return {"created": datetime.datetime.now().isoformat(),
+            "host": {"platform": platform.platform(), "python": platform.python_version(),
+                     "cores": os.cpu_count()},
+            "results": results}
+
+
+def compare(run, baseline, tolerance=TOLERANCE):
+    """
+    Matches results to the baseline by benchmark and scale.
+    :return: list of (benchmark, scale, baseline seconds, seconds, change) of the slower than tolerance results
+    """
+    saved = {(result["benchmark"], result["scale"]): result["seconds"] for result in baseline["results"]}
+    regressions = []
+    for result in run["results"]:
+        before = saved.get((result["benchmark"], result["scale"]))
+        if before is None or before <= 0:
+            continue
+        change = result["seconds"] / before - 1
+        sys.stderr.write("{0} at scale {1}: {2:.2f} s, baseline {3:.2f} s ({4:+.0%})\n".format(
+            result["benchmark"], result["scale"], result["seconds"], before, change))
+        if change > tolerance:
+            regressions.append((result["benchmark"], result["scale"], before, result["seconds"], change))
+    return regressions
+
+
+def parse_list(text):
+    return [int(float(value)) for value in text.split(",") if value.strip() != ""]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Benchmarks of the import, union and aggregation of main.py, its local "
+                                          "engine and the permutations of stats.py over synthetic data.")
+    parser.add_argument("-b", "--benchmarks", help="Comma separated benchmarks, default all: {0}."
+                        .format(",".join(PIPELINE_BENCHMARKS + LOCAL_BENCHMARKS + STATS_BENCHMARKS)),
+                        default=",".join(PIPELINE_BENCHMARKS + LOCAL_BENCHMARKS + STATS_BENCHMARKS))
+    parser.add_argument("--samples", help="Comma separated sample counts of the pipeline and local benchmarks.",
+                        type=parse_list, default=SAMPLE_SCALES)
+    parser.add_argument("--permutations", help="Comma separated permutation counts (e.g. 1e4,1e5).",
+                        type=parse_list, default=PERMUTATION_SCALES)
+    parser.add_argument("-v", "--variants", help="Distinct sites of the synthetic cohort.", type=int, default=20000)
+    parser.add_argument("--sample-variants", help="Sites per synthetic sample.", type=int, default=2000)
+    parser.add_argument("-g", "--genes", help="Genes of the synthetic cohort.", type=int, default=500)
+    parser.add_argument("--vep-cache", help="See main.py Readvcfs --vep-cache.", type=str)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-w", "--workers", help="Worker processes of the permutations and of local.", type=int,
+                        default=1)
+    parser.add_argument("-t", "--tmp", help="Folder for the synthetic data and the benchmark outputs.", type=str)
+    parser.add_argument("-o", "--out", help="JSON results path, printed to stdout if not given.", type=Path)
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with.", type=Path)
+    parser.add_argument("--compare-engines", help="Instead of the benchmarks, build gnomad.tsv of a synthetic cohort "
+                                                  "of this many samples and of edge case entries with the Hail and the "
+                                                  "local engine, exit with 1 if the files differ.", type=int)
+    parser.add_argument("--tolerance", help="Slowdown over the baseline flagged as a regression (default {0})."
+                        .format(TOLERANCE), type=float, default=TOLERANCE)
+    args = parser.parse_args()
+    if args.compare_engines is not None:
+        import hail as hl
+        hl.init(min_block_size=128)
+        compare_dir = Path(tempfile.mkdtemp(dir=args.tmp))
+        comparison = compare_engines(args.compare_engines, compare_dir, args.variants, args.sample_variants,
+                                     args.genes, args.seed, args.vep_cache, args.workers)
+        print(json.dumps(comparison, indent=1))
+        failed = not comparison["identical"] or \
+            any(not outcome.startswith("failed") for outcomes in comparison["failing"].values()
+                for outcome in outcomes.values())
+        if failed:
+            sys.stderr.write("The engines differ, the outputs are kept in {0}\n".format(compare_dir))
+            sys.exit(1)
+        shutil.rmtree(compare_dir, ignore_errors=True)
+        sys.exit(0)
+    benchmarks = [benchmark.strip() for benchmark in args.benchmarks.split(",")]
+    unknown = [benchmark for benchmark in benchmarks
+               if benchmark not in PIPELINE_BENCHMARKS + LOCAL_BENCHMARKS + STATS_BENCHMARKS]
+    if len(unknown) > 0:
+        parser.error("Unknown benchmarks: {0}".format(", ".join(unknown)))
+    run = run_benchmarks(benchmarks, args.samples, args.permutations, args.tmp, args.seed, args.workers,
+                         {"variants": args.variants, "sample_variants": args.sample_variants, "genes": args.genes,
+                          "vep_cache": args.vep_cache})
+    if args.out is not None:
+        with args.out.open("w") as f:
+            json.dump(run, f, indent=1)
+    else:
+        print(json.dumps(run, indent=1))
+    if args.baseline is not None:
+        with args.baseline.open() as f:
+            regressions = compare(run, json.load(f), args.tolerance)
+        for benchmark, scale, before, seconds, change in regressions:
+            sys.stderr.write("REGRESSION: {0} at scale {1} took {2:.2f} s, baseline {3:.2f} s ({4:+.0%})\n"
+                             .format(benchmark, scale, seconds, before, change))
+        if len(regressions) > 0:
+            sys.exit(1)
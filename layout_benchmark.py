@@ -0,0 +1,89 @@
+import argparse
+import datetime
+import json
+import shutil
+import sys
+import tempfile
+import urllib.request
+from pathlib import Path
+
+import hail as hl
+
+import main
+
+
+def shuffle_bytes():
+    """
+    Shuffle bytes written so far by the Spark application, summed over its stages from the Spark UI REST API.
+    """
+    sc = hl.spark_context()
+    url = "{0}/api/v1/applications/{1}/stages".format(sc.uiWebUrl, sc.applicationId)
+    with urllib.request.urlopen(url) as response:
+        stages = json.load(response)
+    return sum(stage.get("shuffleWriteBytes", 0) for stage in stages)
+
+
+def measure(name, tables, out, af_edges):
+    """
+    Unions the tables, aggregates them with gnomad_table and writes the result, recording the wall time and the
+    shuffle bytes of the whole run.
+    :return: dict of the measurements
+    """
+    before = shuffle_bytes()
+    start = datetime.datetime.now()
+    main.gnomad_table(main.table_join(tables), af_edges).write(out, overwrite=True)
+    elapsed = (datetime.datetime.now() - start).total_seconds()
+    result = {"path": name, "tables": len(tables), "seconds": elapsed, "shuffle_bytes": shuffle_bytes() - before}
+    sys.stderr.write("{0}: {1:.1f} s, {2} shuffle bytes\n".format(name, elapsed, result["shuffle_bytes"]))
+    return result
+
+
+def run_benchmark(dest, number=-1, af_edges=main.AF_BIN_EDGES, work_dir=None):
+    """
+    Compares collating the MatrixTables of dest through mts_to_table (re-keyed by gene on every load) with the
+    gene layout (sorted once, read with shared partition boundaries). Building the gene layout is measured
+    separately as it is a one-off cost. The frequency tables of both paths must be equal.
+    :return: list of measurement dicts
+    """
+    work_dir = Path(tempfile.mkdtemp(dir=work_dir))
+    try:
+        hailtables = main.open_matrixtables(main.discover_sample_folders(Path(dest), number))
+        results = [measure("mts_to_table", main.mts_to_table(list(hailtables.values())),
+                           work_dir.joinpath("rekeyed.ht").__str__(), af_edges)]
+        before = shuffle_bytes()
+        start = datetime.datetime.now()
+        main.write_gene_layout(dest, hailtables)
+        results.append({"path": "gene_layout_build", "tables": len(hailtables),
+                        "seconds": (datetime.datetime.now() - start).total_seconds(),
+                        "shuffle_bytes": shuffle_bytes() - before})
+        results.append(measure("gene_layout", main.read_gene_layout(dest, list(hailtables)),
+                               work_dir.joinpath("layout.ht").__str__(), af_edges))
+        rekeyed = hl.read_table(work_dir.joinpath("rekeyed.ht").__str__())
+        layout = hl.read_table(work_dir.joinpath("layout.ht").__str__())
+        # Entries without a gene are not in the layout
+        rekeyed = rekeyed.filter(hl.is_defined(rekeyed.gene))
+        if not rekeyed._same(layout):
+            sys.stderr.write("WARNING: The frequency tables of the two paths differ\n")
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Benchmark of the gene layout against re-keying the per sample "
+                                          "MatrixTables on every load.")
+    parser.add_argument("-d", "--directory", help="Readvcfs destination folder with the MatrixTables.",
+                        required=True)
+    parser.add_argument("-n", "--number", help="Number of tables to be collated.", type=int, default=-1)
+    parser.add_argument("--af-bins", help="See main.py Readvcfs --af-bins.", type=main.parse_af_edges,
+                        default=main.AF_BIN_EDGES)
+    parser.add_argument("-t", "--tmp", help="Folder for the benchmark outputs.", type=str)
+    parser.add_argument("-o", "--out", help="JSON results path, printed to stdout if not given.", type=Path)
+    args = parser.parse_args()
+    hl.init(min_block_size=128)
+    results = run_benchmark(Path(args.directory), args.number, args.af_bins, args.tmp)
+    if args.out is not None:
+        with args.out.open("w") as f:
+            json.dump(results, f, indent=1)
+    else:
+        print(json.dumps(results, indent=1))
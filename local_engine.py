@@ -0,0 +1,193 @@
+import datetime
+import gzip
+import math
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+# CSQ fields append_table reads, by name from the CSQ header (positions 0 to 3 of the vep_settings.json layout)
+CSQ_IMPACT = "IMPACT"
+CSQ_GENE = "SYMBOL"
+CSQ_MAX_AF = "MAX_AF"
+# Minimum variant fraction (AD[1] / DP) of an entry, see main.append_table
+MIN_VARIANT_FRACTION = 0.3
+
+
+def _open_vcf(path):
+    path = str(path)
+    if path.endswith(".gz") or path.endswith(".bgz"):
+        return gzip.open(path, "rt")
+    return open(path)
+
+
+def csq_format(line):
+    """
+    :param line: ##INFO=<ID=CSQ,...> header line of a VEP annotated VCF
+    :return: list of the CSQ field names, from "Format: A|B|..." of its description
+    """
+    description = line.split("Description=\"", 1)[1].rsplit("\"", 1)[0]
+    return description.split("Format: ", 1)[1].strip().split("|")
+
+
+def _int(text):
+    return None if text == "." or text == "" else int(text)
+
+
+def variant_fraction(ad, dp):
+    """
+    AD[1] / DP as Hail computes it (float64 division, x / 0 is inf or nan), None where missing. A one element AD
+    fails like AD[1] does in Hail, and so does a missing element of AD (e.g. 3,.), which hl.import_vcf refuses
+    with its default array_elements_required=True. The Hail path can't import either VCF.
+    """
+    if ad is None or ad == ".":
+        return None
+    depths = ad.split(",")
+    if len(depths) < 2:
+        raise ValueError("AD {0} has no alternative allele depth".format(ad))
+    if "." in depths:
+        raise ValueError("AD {0} has a missing element".format(ad))
+    alt_depth = _int(depths[1])
+    dp = None if dp is None else _int(dp)
+    if alt_depth is None or dp is None:
+        return None
+    if dp == 0:
+        return math.inf if alt_depth > 0 else math.nan
+    return alt_depth / dp
+
+
+def alt_allele_count(gt):
+    """
+    GT.n_alt_alleles() of a VCF genotype, None for a missing call.
+    """
+    if gt is None:
+        return None
+    alleles = gt.replace("|", "/").split("/")
+    if any(allele == "." or allele == "" for allele in alleles):
+        return None
+    return sum(1 for allele in alleles if int(allele) != 0)
+
+
+def _info_csq(info):
+    for field in info.split(";"):
+        if field.startswith("CSQ="):
+            return field[4:]
+    return None
+
+
+def vcf_counts(path, impacts, af_edges):
+    """
+    Streams a VEP annotated VCF and sums its alternative allele counts by gene, impact and MAX_AF bin, applying
+    main.append_table and main.project_table to every entry: star allele rows are skipped, AC is the number of
+    alternative alleles of GT and entries with a missing or zero AC, or a variant fraction AD[1] / DP missing or
+    below MIN_VARIANT_FRACTION, are left out. Impact, gene and MAX_AF come from the first CSQ annotation of the
+    row, an empty MAX_AF is missing.
+    :param impacts: Counted impacts in the order of the cells, see main.IMPACTS
+    :param af_edges: Increasing inner MAX_AF bin edges
+    :return: dict of gene (None where missing) -> int64 array of the cells (impact x AF bin, the missing MAX_AF
+    bin last), genes are present once they have an entry even if no cell counts it
+    """
+    n_bins = len(af_edges) + 2
+    impact_code = {impact: i for i, impact in enumerate(impacts)}
+    counts = dict()
+    fields = None
+    with _open_vcf(path) as f:
+        for line in f:
+            if line.startswith("##"):
+                if line.startswith("##INFO=<ID=CSQ,"):
+                    fields = csq_format(line)
+                continue
+            if line.startswith("#"):
+                continue
+            columns = line.rstrip("\n").split("\t")
+            alts = columns[4].split(",")
+            if alts[0] == "*" or len(columns) < 10:
+                continue
+            keys = columns[8].split(":")
+            positions = [keys.index(key) if key in keys else None for key in ("GT", "AD", "DP")]
+            cell, gene, row_parsed = None, None, False
+            for sample in columns[9:]:
+                values = sample.split(":")
+                gt, ad, dp = [values[p] if p is not None and p < len(values) else None for p in positions]
+                ac = alt_allele_count(gt)
+                try:
+                    vf = variant_fraction(ad, dp)
+                except ValueError as e:
+                    raise ValueError("{0} {1}:{2}: {3}".format(path, columns[0], columns[1], e))
+                if ac is None or ac <= 0 or vf is None or not vf >= MIN_VARIANT_FRACTION:
+                    continue
+                if not row_parsed:
+                    row_parsed = True
+                    csq = _info_csq(columns[7])
+                    if csq is not None:
+                        if fields is None:
+                            raise ValueError("{0} has CSQ annotations but no CSQ header".format(path))
+                        annotation = dict(zip(fields, csq.split(",")[0].split("|")))
+                        gene = annotation[CSQ_GENE]
+                        max_af = None if annotation[CSQ_MAX_AF] == "" else float(annotation[CSQ_MAX_AF])
+                        code = impact_code.get(annotation[CSQ_IMPACT])
+                        if code is not None:
+                            af_bin = n_bins - 1 if max_af is None else sum(max_af >= edge for edge in af_edges)
+                            cell = code * n_bins + af_bin
+                cells = counts.get(gene)
+                if cells is None:
+                    cells = counts[gene] = np.zeros(len(impacts) * n_bins, dtype=np.int64)
+                if cell is not None:
+                    cells[cell] += ac
+    return counts
+
+
+def _merge(total, counts):
+    for gene, cells in counts.items():
+        if gene in total:
+            total[gene] += cells
+        else:
+            total[gene] = cells
+    return total
+
+
+def cohort_counts(vcfs, impacts, af_edges, workers=1):
+    """
+    vcf_counts summed over VCFs, read by a pool of workers processes (in process for 1).
+    :return: dict of gene -> int64 array of the cells
+    """
+    total = dict()
+    vcfs = sorted(str(vcf) for vcf in vcfs)
+    if len(vcfs) == 0:
+        return total
+    start = datetime.datetime.now()
+    step = max(1, len(vcfs) // 20)
+    sys.stderr.write("Reading {0} VCF(s) with {1} worker(s)\n".format(len(vcfs), workers))
+    if workers <= 1:
+        results = (vcf_counts(vcf, impacts, af_edges) for vcf in vcfs)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        results = (future.result() for future in
+                   as_completed([pool.submit(vcf_counts, vcf, impacts, af_edges) for vcf in vcfs]))
+    try:
+        for done, counts in enumerate(results, 1):
+            _merge(total, counts)
+            if done % step == 0 or done == len(vcfs):
+                sys.stderr.write("Read {0}/{1} VCFs ({2}%), {3}\n".format(
+                    done, len(vcfs), done * 100 // len(vcfs), datetime.datetime.now() - start))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return total
+
+
+def write_tsv(counts, path, impacts, bin_names):
+    """
+    Writes the counts as main.gnomad_table(...).flatten().export(path) does: a gene column followed by
+    <impact>.<bin> columns, genes sorted with the missing gene (NA) last.
+    """
+    header = ["gene"] + ["{0}.{1}".format(impact.lower(), name) for impact in impacts for name in bin_names]
+    genes = sorted(gene for gene in counts if gene is not None) + ([None] if None in counts else [])
+    tmp = "{0}.tmp".format(path)
+    with open(tmp, "w", newline="\n") as f:
+        f.write("\t".join(header) + "\n")
+        for gene in genes:
+            f.write("\t".join(["NA" if gene is None else gene] + [str(int(c)) for c in counts[gene]]) + "\n")
+    os.replace(tmp, path)
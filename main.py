@@ -1,10 +1,13 @@
 import argparse
 import datetime
 import glob
+import hashlib
+import json
 import os.path
 import re
 import shutil
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from sys import stderr
 
@@ -12,10 +15,180 @@ import hail as hl
 from pyspark import *
 
 import file_utility
+import local_engine
+import profiling
+import resources
+import vep_runner
 
 hail_home = Path(hl.__file__).parent.__str__()
 unique = hash(datetime.datetime.utcnow())
-def vcfs_to_matrixtable(f, destination=None, write=True, annotate=True):
+# VEP impacts in the order of the gnomad_table columns
+IMPACTS = ["MODIFIER", "LOW", "MODERATE", "HIGH"]
+# Inner MAX_AF bin edges of gnomad_table, see af_bin_names
+AF_BIN_EDGES = [0.01, 0.05]
+# VCFs joined into one MatrixTable before it is checkpointed in the cohort import
+JOINT_BATCH_SIZE = 100
+VEP_CONFIG = "vep_settings.json"
+# Fields kept by project_table, gene first
+PROJECTED_ROW_FIELDS = ["gene", "impact", "MAX_AF"]
+PROJECTED_ENTRY_FIELDS = ["AC"]
+# Folder of the gene keyed per sample tables in a Readvcfs destination, see write_gene_layout
+GENE_LAYOUT = "gene_layout"
+# Partitions shared by every table of the gene layout
+GENE_LAYOUT_PARTITIONS = 64
+# Upper bound of the last gene layout partition, above any gene symbol
+GENE_KEY_MAX = "\U0010ffff"
+# Threads opening MatrixTables in load_hailtables
+READ_WORKERS = 16
+# Processes reading VCFs in Readvcfs --engine local
+LOCAL_WORKERS = os.cpu_count() or 1
+# Sidecar file of a Readvcfs destination, see write_phenotype_index
+PHENOTYPE_INDEX = "phenotype_index.tsv"
+# Tables unioned at once by table_join
+UNION_GROUP_SIZE = 64
+# Folder of the incremental frequency table in a Readvcfs destination, see update_gnomad_table
+INCREMENTAL_STORE = "gnomad_incremental"
+# Segments of the VEP annotation cache merged into one once there are more than this
+VEP_CACHE_MAX_SEGMENTS = 16
+# Write-ahead manifest of a Readvcfs destination and the folder its tables are written to first, see ImportManifest
+IMPORT_MANIFEST = "import_manifest.json"
+IMPORT_TMP = "import_tmp"
+# States of a sample in the import manifest, in order
+IMPORT_STATES = ["pending", "vep_done", "written", "validated"]
+
+
+def vep_settings_hash(config=VEP_CONFIG):
+    """
+    Tag of a VEP configuration, a hash of its command and output schema. Annotations cached under another tag
+    were made with different settings and are not reused.
+    """
+    with open(config) as f:
+        settings = json.load(f)
+    key = json.dumps([settings["command"], settings.get("vep_json_schema")], sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+class VepCache():
+    """
+    Persistent site level VEP annotations shared by samples and runs: Hail Tables keyed by locus and alleles in
+    <directory>/vep_<settings hash>/. Only sites missing from the cache are sent to VEP and their annotations are
+    added as a new segment; segments are merged once there are more than VEP_CACHE_MAX_SEGMENTS, so adding a
+    batch does not rewrite the whole cache.
+    """
+    def __init__(self, directory, config=VEP_CONFIG, runner=None):
+        self.config = config
+        self.runner = runner
+        self.tag = vep_settings_hash(config)
+        self.path = Path(directory).joinpath("vep_{0}".format(self.tag))
+
+    def segments(self):
+        return sorted(self.path.glob("segment_*.ht")) if self.path.exists() else []
+
+    def read(self):
+        """
+        :return: Table of every cached site, None if the cache is empty
+        """
+        tables = [hl.read_table(segment.__str__()) for segment in self.segments()]
+        if len(tables) == 0:
+            return None
+        return tables[0].union(*tables[1:]) if len(tables) > 1 else tables[0]
+
+    def _write_segment(self, table):
+        # Written under a temporary name and renamed, an interrupted write never shows up as a segment
+        self.path.mkdir(parents=True, exist_ok=True)
+        segments = self.segments()
+        number = int(segments[-1].stem.split("_")[1]) + 1 if len(segments) > 0 else 0
+        segment = self.path.joinpath("segment_{0:06d}.ht".format(number))
+        tmp = self.path.joinpath("tmp_{0:06d}.ht".format(number))
+        if tmp.exists():
+            shutil.rmtree(tmp)
+        table.write(tmp.__str__())
+        os.rename(tmp, segment)
+        return segment
+
+    def compact(self):
+        segments = self.segments()
+        if len(segments) <= 1:
+            return
+        sys.stderr.write("Merging {0} VEP cache segments in {1}\n".format(len(segments), self.path))
+        self._write_segment(self.read())
+        for segment in segments:
+            shutil.rmtree(segment)
+
+    def annotate(self, table):
+        """
+        Annotates the rows of a MatrixTable (or Table) keyed by locus and alleles with the vep field of
+        hl.methods.vep(..., csq=True), running VEP only over the sites not cached yet.
+        """
+        sites = table.rows().select() if isinstance(table, hl.MatrixTable) else table.select()
+        cached = self.read()
+        novel = sites if cached is None else sites.anti_join(cached)
+        novel_count = novel.count()
+        if novel_count > 0:
+            sys.stderr.write("Running VEP on {0} site(s) missing from the cache {1}\n".format(novel_count, self.path))
+            self._write_segment(vep_sites(novel, self.config, self.runner))
+            if len(self.segments()) > VEP_CACHE_MAX_SEGMENTS:
+                self.compact()
+            cached = self.read()
+        else:
+            sys.stderr.write("All sites are in the VEP cache {0}, VEP not started\n".format(self.path))
+        if cached is None:
+            # No sites and nothing cached yet, there is nothing to join with
+            if isinstance(table, hl.MatrixTable):
+                return table.annotate_rows(vep=hl.missing(hl.tarray(hl.tstr)))
+            return table.annotate(vep=hl.missing(hl.tarray(hl.tstr)))
+        if isinstance(table, hl.MatrixTable):
+            return table.annotate_rows(vep=cached[table.row_key].vep)
+        return table.annotate(vep=cached[table.key].vep)
+
+
+@profiling.timed()
+def runner_vep(sites, runner):
+    """
+    Runs a VepRunner over the sites of a Table keyed by locus and alleles: the sites are exported in key order,
+    annotated chunk by chunk and the chunk results are read back.
+    :return: Table keyed by locus and alleles with the vep field of hl.methods.vep(..., csq=True), sites VEP did not
+    annotate are left out
+    """
+    path = runner.sites_path()
+    flat = sites.key_by()
+    flat.select(contig=flat.locus.contig, position=flat.locus.position, ref=flat.alleles[0],
+                alts=hl.delimit(flat.alleles[1:], ",")).export(path)
+    chunks = [chunk.__str__() for chunk in runner.run(path)]
+    os.remove(path)
+    if len(chunks) == 0:
+        return sites.select().annotate(vep=hl.missing(hl.tarray(hl.tstr)))
+    annotated = hl.import_table(chunks, no_header=True)
+    annotated = annotated.key_by(
+        locus=hl.locus(annotated.f0, hl.int32(annotated.f1), reference_genome=sites.locus.dtype.reference_genome),
+        alleles=hl.array([annotated.f2]).extend(annotated.f3.split(",")))
+    return annotated.select(vep=annotated.f4.split(","))
+
+
+def vep_sites(table, config=VEP_CONFIG, runner=None):
+    """
+    hl.methods.vep(table, config, csq=True), or the same vep field from the chunked VEP worker pool of a VepRunner.
+    """
+    if runner is None:
+        return hl.methods.vep(table, config=config, csq=True)
+    if isinstance(table, hl.MatrixTable):
+        annotated = runner_vep(table.rows().select(), runner)
+        return table.annotate_rows(vep=annotated[table.row_key].vep)
+    annotated = runner_vep(table.select(), runner)
+    return table.annotate(vep=annotated[table.key].vep)
+
+
+def run_vep(table, vep_cache=None, runner=None):
+    """
+    hl.methods.vep with the repository settings, through the VepCache in the vep_cache directory if given.
+    :param runner: VepRunner to run VEP with instead of one VEP process per partition
+    """
+    if vep_cache is None:
+        return vep_sites(table, VEP_CONFIG, runner)
+    return VepCache(vep_cache, VEP_CONFIG, runner).annotate(table)
+
+@profiling.timed()
+def vcfs_to_matrixtable(f, destination=None, write=True, annotate=True, vep_cache=None, vep_runner=None):
     files = list()
     if type(f) is list:
         for vcf in f:
@@ -59,7 +232,7 @@ def vcfs_to_matrixtable(f, destination=None, write=True, annotate=True):
                                                                                          "chrY": "Y"})
     if annotate:
         table = table.filter_rows(table.alleles[1] != '*')  # These alleles break VEP, filter out star alleles.
-        table = hl.methods.vep(table, config="vep_settings.json", csq=True)
+        table = run_vep(table, vep_cache, vep_runner)
     if write:
         if not os.path.exists(destination):
             table.write(destination)
@@ -75,6 +248,7 @@ def parse_empty(text):
 def parse_csq(vcf):
     return None
 
+@profiling.timed()
 def append_table(table, prefix, out=None, write=False, metadata=None):
     # mt_a = table.annotate_rows(CSQ=table.info.CSQ.first().split("\\|"))
     # # mt_a = mt_a.drop(mt_a.info) # Drop the already split string
@@ -97,9 +271,7 @@ def append_table(table, prefix, out=None, write=False, metadata=None):
     mt_a = mt_a.drop(mt_a.info)
     mt_a = mt_a.filter_entries(mt_a.VF>=0.3, keep=True)  # Remove all not ALT_pos/DP < 0.3
     if metadata is not None:
-        phen, mut = metadata.get(prefix, ["NA","NA"])
-        if len(phen) == 0: phen="NA"
-        if len(mut) == 0: mut = "NA"
+        phen, mut = sample_metadata(metadata, prefix)
         mt_a = mt_a.annotate_globals(metadata=hl.struct(phenotype = phen, mutation=mut))
 
     if write and out is not None:
@@ -107,6 +279,83 @@ def append_table(table, prefix, out=None, write=False, metadata=None):
     return mt_a
 
 
+def project_table(mt):
+    """
+    Slim form of an append_table MatrixTable, the only fields gnomad_table reads: gene, impact and MAX_AF per row
+    and AC per entry. Entries filtered out by append_table or without an alternative allele are removed, and so are
+    rows left without entries. Columns and globals (the sample metadata) are kept.
+    """
+    mt = mt.select_rows(*PROJECTED_ROW_FIELDS).select_entries(*PROJECTED_ENTRY_FIELDS)
+    mt = mt.filter_entries(mt.AC > 0)
+    return mt.filter_rows(hl.agg.count() > 0)
+
+
+def sample_metadata(metadata, prefix):
+    """
+    :return: tuple of (phenotype, mutation) of a sample, "NA" where unknown or empty
+    """
+    phen, mut = metadata.get(prefix, ["NA", "NA"])
+    if len(phen) == 0: phen = "NA"
+    if len(mut) == 0: mut = "NA"
+    return phen, mut
+
+
+@profiling.timed()
+def vcfs_to_cohort_matrixtable(vcfs, destination, batch_size=JOINT_BATCH_SIZE, metadata=None, vep_cache=None,
+                               resume=False, vep_runner=None):
+    """
+    Cohort import: joins single sample VCFs into one sample indexed MatrixTable instead of one MatrixTable per
+    sample. VCFs are imported lazily and joined column wise (outer join on locus and alleles) in batches of
+    batch_size, every batch is checkpointed so the query plan stays bounded, and the batches are joined the same
+    way. VEP then runs once over the distinct variant sites of the cohort and the annotation is joined back before
+    append_table. The sample prefix and its phenotype and mutation are column fields (prefix, metadata) rather
+    than globals.
+    :param vcfs: VCF paths
+    :param destination: Path of the cohort MatrixTable
+    :param batch_size: VCFs per checkpointed batch
+    :param metadata: dict of prefix -> [phenotype, mutation], see get_metadata
+    :param vep_cache: Directory of the VepCache, None runs VEP over every site
+    :param resume: Read the batches completed by an interrupted run of the same VCFs instead of importing them again
+    :param vep_runner: VepRunner to run VEP with, see run_vep
+    :return: The written cohort MatrixTable
+    """
+    batch_dir = Path(destination).with_name(Path(destination).name + "_batches")
+    batches = []
+    for b in range(0, len(vcfs), batch_size):
+        batch_path = batch_dir.joinpath("batch_{0}".format(len(batches)))
+        if resume and write_complete(batch_path):
+            batches.append(hl.read_matrix_table(batch_path.__str__()))
+            sys.stderr.write("Batch {0} was imported by an earlier run\n".format(len(batches)))
+            continue
+        batch = None
+        for vcfpath in vcfs[b:b + batch_size]:
+            assert vcfpath.exists()
+            prefix = file_utility.trim_prefix(vcfpath.stem)
+            mt = vcfs_to_matrixtable(vcfpath.__str__(), write=False, annotate=False)
+            # Only the keys and the entry fields append_table uses, VCF generations differ in their INFO fields
+            # Samples are keyed by the file prefix, VCF sample names are not unique across runs
+            mt = mt.key_cols_by(prefix=prefix).select_cols("s").select_rows().select_entries("GT", "AD", "DP")
+            batch = mt if batch is None else batch.union_cols(mt, row_join_type="outer")
+        batches.append(batch.checkpoint(batch_path.__str__(), overwrite=True))
+        sys.stderr.write("Imported batch {0} of {1} ({2} VCFs)\n".format(
+            len(batches), -(-len(vcfs) // batch_size), len(vcfs[b:b + batch_size])))
+    cohort = batches[0]
+    for batch in batches[1:]:
+        cohort = cohort.union_cols(batch, row_join_type="outer")
+    cohort = cohort.filter_rows(cohort.alleles[1] != '*')  # These alleles break VEP, filter out star alleles.
+
+    sites = run_vep(cohort.rows().select(), vep_cache, vep_runner)
+    cohort = cohort.annotate_rows(vep=sites[cohort.row_key].vep)
+    if metadata is not None:
+        phenotypes = hl.literal({prefix: sample_metadata(metadata, prefix) for prefix in metadata})
+        sample = phenotypes.get(cohort.prefix, hl.literal(("NA", "NA")))
+        cohort = cohort.annotate_cols(metadata=hl.struct(phenotype=sample[0], mutation=sample[1]))
+    cohort = project_table(append_table(cohort.annotate_rows(info=hl.struct()), None))
+    cohort.write(Path(destination).__str__(), overwrite=True)
+    shutil.rmtree(batch_dir, ignore_errors=True)
+    return hl.read_matrix_table(Path(destination).__str__())
+
+
 def parse_tables(tables):
     mt_tables = []
     # Positional arguments from VEP annotated CSQ string. TODO: Query from VCF header
@@ -118,12 +367,127 @@ def parse_tables(tables):
 
 def mts_to_table(tables):
     for i, tb in enumerate(tables):
-        tb = tb.key_cols_by()
+        tb = tb.key_cols_by().select_cols()
+        tb = project_table(tb)  # Also slims down tables stored before the projection
         tb = tb.entries()  # Convert from MatrixTable to Table
-        tables[i] = tb.key_by(tb.gene)  # Key by gene
+        tables[i] = tb.key_by(tb.gene).select(*PROJECTED_ROW_FIELDS[1:], *PROJECTED_ENTRY_FIELDS)  # Key by gene
     return tables
 
 
+def _read_layout(dest):
+    # layout.json of the gene layout of dest: the partition boundaries and the source identity of every table
+    path = Path(dest).joinpath(GENE_LAYOUT, "layout.json")
+    if not path.exists():
+        return {"boundaries": None, "sources": dict()}
+    with path.open() as f:
+        layout = json.load(f)
+    layout.setdefault("sources", dict())
+    return layout
+
+
+def _write_layout(dest, layout):
+    # Replaced atomically, like the import manifest
+    path = Path(dest).joinpath(GENE_LAYOUT, "layout.json")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w") as f:
+        json.dump(layout, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def table_identity(path):
+    """
+    :return: Modification time (ns) of the _SUCCESS file Hail writes last, it changes whenever the table is written
+    again (Readvcfs --overwrite, a re-import). None for an incomplete table.
+    """
+    success = Path(path).joinpath("_SUCCESS")
+    return success.stat().st_mtime_ns if success.exists() else None
+
+
+def gene_layout_boundaries(dest, tables=None, partitions=GENE_LAYOUT_PARTITIONS):
+    """
+    Gene partition boundaries shared by every table of the gene layout of dest. Chosen once, as gene quantiles of
+    the first tables written to the layout, and kept in layout.json so that later tables line up with them.
+    :param tables: Gene keyed tables to choose the boundaries from if the layout has none yet
+    :return: Sorted list of the first gene of every partition but the first
+    """
+    layout = _read_layout(dest)
+    if layout["boundaries"] is not None:
+        return layout["boundaries"]
+    if tables is None:
+        raise FileNotFoundError("The gene layout of {0} has no layout.json, collate with --gene-layout to write it"
+                                .format(dest))
+    genes = set()
+    for tb in tables[:8]:
+        genes |= tb.aggregate(hl.agg.collect_as_set(tb.gene))
+    genes = sorted(gene for gene in genes if gene is not None)
+    layout["boundaries"] = sorted(set(genes[len(genes) * p // partitions] for p in range(1, partitions))) \
+        if genes else []
+    _write_layout(dest, layout)
+    return layout["boundaries"]
+
+
+def _layout_intervals(boundaries):
+    points = [""] + boundaries + [GENE_KEY_MAX]
+    return [hl.Interval(hl.Struct(gene=start), hl.Struct(gene=end), includes_start=True,
+                        includes_end=i == len(points) - 2) for i, (start, end) in enumerate(zip(points, points[1:]))]
+
+
+def write_gene_layout(dest, hailtables, partitions=GENE_LAYOUT_PARTITIONS):
+    """
+    Writes the gene keyed entries (see mts_to_table) of every MatrixTable missing from the gene layout of dest, or
+    whose MatrixTable was written again since (see table_identity), to <dest>/GENE_LAYOUT/<prefix>.ht. Each table
+    is sorted by gene once, here, instead of on every load. Entries without a gene are left out. The identity of
+    the source MatrixTable of every layout table is kept in layout.json, a layout without one is written again.
+    :param hailtables: dict of prefix -> MatrixTable
+    """
+    layout = Path(dest).joinpath(GENE_LAYOUT)
+    sources = _read_layout(dest)["sources"]
+    folders = _sample_folders(dest)
+    folders["cohort_mt"] = Path(dest).joinpath("cohort_mt")
+    identities = {prefix: table_identity(folders[prefix]) if prefix in folders else None for prefix in hailtables}
+    missing = {prefix: mt for prefix, mt in hailtables.items()
+               if not layout.joinpath(prefix + ".ht").exists() or identities[prefix] is None
+               or sources.get(prefix) != identities[prefix]}
+    if len(missing) == 0:
+        return
+    stale = len([prefix for prefix in missing if layout.joinpath(prefix + ".ht").exists()])
+    sys.stderr.write("Writing {0} table(s) to the gene layout {1}, {2} of them changed since they were written\n"
+                     .format(len(missing), layout, stale))
+    tables = dict(zip(missing, mts_to_table(list(missing.values()))))
+    gene_layout_boundaries(dest, list(tables.values()), partitions)
+    for prefix, tb in tables.items():
+        tmp = layout.joinpath(prefix + ".ht.tmp")
+        tb.filter(hl.is_defined(tb.gene)).write(tmp.__str__(), overwrite=True)
+        replace_folder(tmp, layout.joinpath(prefix + ".ht"))
+        current = _read_layout(dest)
+        current["sources"][prefix] = identities[prefix]
+        _write_layout(dest, current)
+
+
+def read_gene_layout(dest, prefixes):
+    """
+    Reads gene layout tables with the shared partition boundaries, so that they are partitioned alike: their
+    union and the per gene aggregation of gnomad_table run partition by partition without a shuffle.
+    :return: list of gene keyed Tables
+    """
+    intervals = _layout_intervals(gene_layout_boundaries(dest))
+    return [hl.read_table(Path(dest).joinpath(GENE_LAYOUT, prefix + ".ht").__str__(), _intervals=intervals)
+            for prefix in prefixes]
+
+
+def entry_tables(dest, hailtables, gene_layout=False):
+    """
+    Gene keyed entry tables of MatrixTables, from the gene layout (written first where missing) or by re-keying
+    them with mts_to_table.
+    :param hailtables: dict of prefix -> MatrixTable
+    """
+    if not gene_layout:
+        return mts_to_table(list(hailtables.values()))
+    write_gene_layout(dest, hailtables)
+    return read_gene_layout(dest, list(hailtables))
+
+
 def mt_join(mt_list):
     mt_final = None
     for i, mt in enumerate(mt_list):
@@ -134,15 +498,49 @@ def mt_join(mt_list):
     return mt_final
 
 
-def table_join(tables_list):
-    # Join Tables into one Table.
-    if tables_list is not None and len(tables_list) > 0:
-        unioned = tables_list[0]  # Initialize with a single table
-    else:
+@profiling.timed()
+def table_join(tables_list, group_size=UNION_GROUP_SIZE, checkpoint_dir=None, partitions=None):
+    """
+    Joins Tables into one Table as a balanced tree of unions: every level unions groups of group_size tables, so
+    no single union is wider than group_size and the tree is log(n) levels deep. Each level can be repartitioned
+    and checkpointed, which cuts the query plan at every level. The number of tables, the leaf tables under each
+    node, the partitions and the time of every level are reported (without checkpoints the time only covers
+    building the plan).
+    :param tables_list: Tables with compatible schemas, see mts_to_table
+    :param group_size: Tables per union
+    :param checkpoint_dir: Folder for the per level checkpoints, None keeps the plan in memory
+    :param partitions: Partitions of every level, None keeps the partitioning of the union
+    :return: Table
+    """
+    if tables_list is None or len(tables_list) == 0:
         raise Exception("No tables to be joined based on current configuration.")
-    if len(tables_list) > 1:
-        unioned = unioned.union(*tables_list[1:], unify=True)
-    return unioned.cache()
+    if group_size < 2:
+        raise ValueError("Union group size must be at least 2, got {0}".format(group_size))
+    level = list(tables_list)
+    leaves = 1
+    depth = 0
+    while len(level) > 1:
+        start = datetime.datetime.now()
+        depth += 1
+        leaves *= group_size
+        unioned = []
+        for g in range(0, len(level), group_size):
+            group = level[g:g + group_size]
+            tb = group[0].union(*group[1:], unify=True) if len(group) > 1 else group[0]
+            if partitions is not None:
+                tb = tb.repartition(partitions)
+            if checkpoint_dir is not None:
+                tb = tb.checkpoint(Path(checkpoint_dir).joinpath("union_{0}".format(unique), "level_{0}".format(depth),
+                                                                 "group_{0}.ht".format(g // group_size)).__str__(),
+                                   overwrite=True)
+            unioned.append(tb)
+        sys.stderr.write("Union level {0}: {1} table(s) into {2}, up to {3} leaf table(s) each, {4} partition(s), "
+                         "{5}\n".format(depth, len(level), len(unioned), min(leaves, len(tables_list)),
+                                        sum(tb.n_partitions() for tb in unioned), datetime.datetime.now() - start))
+        level = unioned
+    if checkpoint_dir is not None and depth > 0:
+        return level[0]
+    return level[0].cache()
 
 
 def get_metadata(metadata_path):
@@ -164,81 +562,397 @@ def get_metadata(metadata_path):
     return metadata_dict
 
 
-def gnomad_table(unioned, text="modifier"):
+def af_bin_names(af_edges):
+    """
+    Names the MAX_AF bins by their percent bounds, e.g. edges [0.01, 0.05] give gnomad_1, gnomad_1_5 and
+    gnomad_5_100, followed by gnomad_NA for variants without a MAX_AF.
+    :param af_edges: Increasing inner bin edges
+    :return: list of bin names
+    """
+    percents = ["{0:g}".format(edge * 100).replace(".", "p") for edge in af_edges]
+    names = ["gnomad_{0}".format(percents[0])]
+    names += ["gnomad_{0}_{1}".format(low, high) for low, high in zip(percents, percents[1:])]
+    names.append("gnomad_{0}_100".format(percents[-1]))
+    return names + ["gnomad_NA"]
+
+
+def parse_af_edges(text):
+    """
+    argparse type of the --af-bins option, comma separated increasing MAX_AF edges between 0 and 1.
+    """
+    edges = [float(edge) for edge in text.split(",") if edge.strip() != ""]
+    if len(edges) == 0 or any(not 0 < edge < 1 for edge in edges) or sorted(set(edges)) != edges:
+        raise argparse.ArgumentTypeError("Expected increasing comma separated MAX_AF edges between 0 and 1, got {0}"
+                                         .format(text))
+    return edges
+
+
+def read_phenotype_index(dest):
+    """
+    :return: dict of prefix -> (phenotype, mutation, MatrixTable path) from the phenotype index of dest, empty if
+    there is none
+    """
+    path = Path(dest).joinpath(PHENOTYPE_INDEX)
+    index = dict()
+    if path.exists():
+        with path.open(encoding="utf-8") as f:
+            next(f, None)  # Header
+            for line in f:
+                s = line.rstrip("\n").split("\t")
+                if len(s) >= 4:
+                    index[s[0]] = (s[1], s[2], s[3])
+    return index
+
+
+def write_phenotype_index(dest, entries):
+    """
+    Adds samples to the phenotype index of dest, a tab delimited prefix, phenotype, mutation and path file written
+    at Readvcfs time. Loaddb --phenotype selects samples from it without opening their MatrixTables.
+    :param entries: dict of prefix -> (phenotype, mutation, MatrixTable path)
+    """
+    index = read_phenotype_index(dest)
+    index.update(entries)
+    path = Path(dest).joinpath(PHENOTYPE_INDEX)
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        f.write("prefix\tphenotype\tmutation\tpath\n")
+        for prefix in sorted(index):
+            f.write("\t".join((prefix,) + tuple(index[prefix])) + "\n")
+    os.replace(tmp, path)
+
+
+@profiling.timed()
+def gnomad_table(unioned, af_edges=AF_BIN_EDGES, count_entries=False):
+    """
+    Sums the alternative allele counts (AC) of every gene by VEP impact and MAX_AF bin in a single aggregation.
+    Each entry gets one integer cell code (impact x AF bin) and the cells are summed with one keyed aggregation,
+    which is then spread into one struct per impact with one field per bin (see af_bin_names). Bins include their
+    lower edge ([0.01, 0.05) for gnomad_1_5), entries without a MAX_AF are counted in gnomad_NA and entries with
+    an impact outside IMPACTS are not counted.
+    :param unioned: Table of entries keyed by gene, see mts_to_table
+    :param af_edges: Increasing inner MAX_AF bin edges
+    :param count_entries: Add the number of entries of every gene as the entries field
+    :return: Table keyed by gene
+    """
     sys.stderr.write("Creating MAX_AF_frequency table\n")
+    names = af_bin_names(af_edges)
+    impact_code = hl.literal({impact: i for i, impact in enumerate(IMPACTS)}).get(unioned.impact)
+    # Number of edges at or below MAX_AF, the missing MAX_AF bin comes last
+    af_bin = hl.if_else(hl.is_missing(unioned.MAX_AF), len(names) - 1,
+                        hl.sum(hl.literal(af_edges).map(lambda edge: hl.int32(unioned.MAX_AF >= edge))))
+    unioned = unioned.annotate(cell=impact_code * len(names) + af_bin)
     gnomad_tb = unioned.group_by(unioned.gene).aggregate(
-        modifier=hl.struct(
-            gnomad_1=hl.agg.filter(
-                (unioned.MAX_AF < 0.01) & (unioned.impact.contains(hl.literal("MODIFIER"))),
-                hl.agg.sum(unioned.AC)),
-            gnomad_1_5=hl.agg.filter((unioned.MAX_AF > 0.01) & (unioned.MAX_AF < 0.05) & (
-                unioned.impact.contains(hl.literal("MODIFIER"))), hl.agg.sum(unioned.AC)),
-            gnomad_5_100=hl.agg.filter((unioned.MAX_AF > 0.05) & (
-                unioned.impact.contains(hl.literal("MODIFIER"))), hl.agg.sum(unioned.AC))),
-        low=hl.struct(
-            gnomad_1=hl.agg.filter(
-                (unioned.MAX_AF < 0.01) & (unioned.impact.contains(hl.literal("LOW"))),
-                hl.agg.sum(unioned.AC)),
-            gnomad_1_5=hl.agg.filter((unioned.MAX_AF > 0.01) & (unioned.MAX_AF < 0.05) & (
-                unioned.impact.contains(hl.literal("LOW"))), hl.agg.sum(unioned.AC)),
-            gnomad_5_100=hl.agg.filter((unioned.MAX_AF > 0.05) & (
-                unioned.impact.contains(hl.literal("LOW"))), hl.agg.sum(unioned.AC))),
-        moderate=hl.struct(
-            gnomad_1=hl.agg.filter(
-                (unioned.MAX_AF < 0.01) & (unioned.impact.contains(hl.literal("MODERATE"))),
-                hl.agg.sum(unioned.AC)),
-            gnomad_1_5=hl.agg.filter((unioned.MAX_AF > 0.01) & (unioned.MAX_AF < 0.05) & (
-                unioned.impact.contains(hl.literal("MODERATE"))), hl.agg.sum(unioned.AC)),
-            gnomad_5_100=hl.agg.filter((unioned.MAX_AF > 0.05) & (
-                unioned.impact.contains(hl.literal("MODERATE"))), hl.agg.sum(unioned.AC))),
-        high=hl.struct(
-            gnomad_1=hl.agg.filter(
-                (unioned.MAX_AF < 0.01) & (unioned.impact.contains(hl.literal("HIGH"))),
-                hl.agg.sum(unioned.AC)),
-            gnomad_1_5=hl.agg.filter((unioned.MAX_AF > 0.01) & (unioned.MAX_AF < 0.05) & (
-                unioned.impact.contains(hl.literal("HIGH"))), hl.agg.sum(unioned.AC)),
-            gnomad_5_100=hl.agg.filter((unioned.MAX_AF > 0.05) & (
-                unioned.impact.contains(hl.literal("HIGH"))), hl.agg.sum(unioned.AC)))
-    )
+        cells=hl.agg.filter(hl.is_defined(unioned.cell), hl.agg.group_by(unioned.cell, hl.agg.sum(unioned.AC))),
+        entries=hl.agg.count())
+    gnomad_tb = gnomad_tb.select(**{
+        impact.lower(): hl.struct(**{name: gnomad_tb.cells.get(i * len(names) + j, hl.int64(0))
+                                     for j, name in enumerate(names)})
+        for i, impact in enumerate(IMPACTS)}, **({"entries": gnomad_tb.entries} if count_entries else {}))
     return gnomad_tb
 
 
-def write_gnomad_table(vcfs, dest, overwrite=False, metadata=None):
-    gnomad_tb = None
+def merge_gnomad_tables(added, removed=(), af_edges=AF_BIN_EDGES, union_options=None):
+    """
+    Adds and subtracts gnomad_table(..., count_entries=True) tables gene by gene. Genes left without entries are
+    dropped, so the result equals gnomad_table over the remaining samples.
+    :param added: Tables whose counts are added
+    :param removed: Tables whose counts are subtracted
+    :param union_options: Keyword arguments of table_join, which unions the tables
+    :return: Table keyed by gene with the entries field
+    """
+    names = af_bin_names(af_edges)
+    fields = [impact.lower() for impact in IMPACTS]
+    negated = [tb.select(**{field: tb[field].annotate(**{name: -tb[field][name] for name in names})
+                            for field in fields}, entries=-tb.entries) for tb in removed]
+    tables = list(added) + negated
+    unioned = table_join(tables, **(union_options or {}))
+    merged = unioned.group_by(unioned.gene).aggregate(
+        **{field: hl.struct(**{name: hl.agg.sum(unioned[field][name]) for name in names}) for field in fields},
+        entries=hl.agg.sum(unioned.entries))
+    return merged.filter(merged.entries > 0)
+
+
+def file_checksum(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_complete(path):
+    # Hail writes _SUCCESS last, a Table or MatrixTable without it was interrupted
+    return Path(path).joinpath("_SUCCESS").exists()
+
+
+def validate_matrixtable(path):
+    """
+    :return: tuple of (rows, columns) of a completely written MatrixTable
+    """
+    if not write_complete(path):
+        raise ValueError("The MatrixTable {0} was not completely written".format(path))
+    return hl.read_matrix_table(Path(path).__str__()).count()
+
+
+def replace_folder(tmp, destination):
+    """
+    Renames the folder tmp to destination. An existing destination is first renamed next to tmp and deleted once
+    replaced, destination never holds a partial table.
+    """
+    tmp, destination = Path(tmp), Path(destination)
+    old = tmp.with_name(tmp.name + ".old")
+    shutil.rmtree(old, ignore_errors=True)
+    if destination.exists():
+        os.rename(destination, old)
+    os.rename(tmp, destination)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+class ImportManifest():
+    """
+    Write-ahead manifest of a Readvcfs destination, <dest>/IMPORT_MANIFEST. Every sample has a state out of
+    IMPORT_STATES and the checksum of its VCF, saved before the next step starts. Tables are written to
+    <dest>/IMPORT_TMP and renamed into dest once validated, so dest only holds complete tables and an interrupted
+    import knows where each sample stopped. The cohort MatrixTable of --joint and gnomad_tb are entries too.
+    """
+    def __init__(self, dest):
+        self.dest = Path(dest)
+        self.path = self.dest.joinpath(IMPORT_MANIFEST)
+        self.tmp = self.dest.joinpath(IMPORT_TMP)
+        self.entries = dict()
+        if self.path.exists():
+            with self.path.open() as f:
+                self.entries = json.load(f)["entries"]
+
+    def save(self):
+        # Replaced atomically, an interrupted save leaves the previous manifest
+        self.dest.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with tmp.open("w") as f:
+            json.dump({"entries": self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def state(self, name):
+        return self.entries.get(name, dict()).get("state")
+
+    def set_state(self, name, state, **fields):
+        self.entries.setdefault(name, dict()).update(state=state, **fields)
+        self.save()
+
+    def register(self, name, vcfpath):
+        """
+        Records the VCF of a sample. A new sample, or one whose VCF checksum changed, is reset to pending. The
+        checksum is only computed again when the size or modification time of the VCF changed.
+        """
+        stat = Path(vcfpath).stat()
+        source = {"vcf": Path(vcfpath).__str__(), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        entry = self.entries.get(name)
+        if entry is not None and all(entry.get(key) == value for key, value in source.items()):
+            return
+        checksum = file_checksum(vcfpath)
+        if entry is not None and entry.get("checksum") == checksum:
+            entry.update(source)
+        else:
+            if entry is not None:
+                sys.stderr.write("The VCF of {0} changed, importing it again\n".format(name))
+            self.entries[name] = dict(state="pending", checksum=checksum, **source)
+        self.save()
+
+    def unfinished(self):
+        return sorted(name for name, entry in self.entries.items() if entry.get("state") != "validated")
+
+    def tmp_path(self, name):
+        self.tmp.mkdir(parents=True, exist_ok=True)
+        return self.tmp.joinpath(name)
+
+
+@profiling.timed()
+def import_sample(manifest, vcfpath, metadata=None, vep_cache=None, overwrite=False, resume=False, vep_runner=None):
+    """
+    Imports one VCF into <dest>/<VCF stem> through the states of the import manifest:
+    pending: The VCF is imported and VEP runs over its sites, the annotated sites are written to IMPORT_TMP
+    vep_done: The VCF is imported again, joined with the annotated sites and the slim form (see project_table) is
+    written to IMPORT_TMP
+    written: The table is validated and renamed into dest
+    validated: Nothing is left to do
+    A validated sample is opened as it is unless overwrite. With resume an unfinished sample continues from its
+    state, otherwise it starts over. A table in dest the manifest does not know (written before manifests) is kept
+    if it is complete.
+    :param manifest: ImportManifest of the destination
+    :return: The sample MatrixTable
+    """
+    name = vcfpath.stem
+    prefix = file_utility.trim_prefix(name)
+    destination = manifest.dest.joinpath(name)
+    sites_path = manifest.tmp_path(name + ".vep.ht")
+    written_path = manifest.tmp_path(name + ".mt")
+    known = name in manifest.entries
+    manifest.register(name, vcfpath)
+    state = manifest.state(name)
+    if overwrite:
+        state = "pending"
+    elif state == "validated" and destination.exists():
+        sys.stderr.write("Overwrite is not active, opening existing file instead: {0}\n".format(destination))
+        return hl.read_matrix_table(destination.__str__())
+    elif not known and write_complete(destination):
+        rows, columns = validate_matrixtable(destination)
+        manifest.set_state(name, "validated", rows=rows, columns=columns)
+        sys.stderr.write("Overwrite is not active, opening existing file instead: {0}\n".format(destination))
+        return hl.read_matrix_table(destination.__str__())
+    elif not resume:
+        state = "pending"
+    # Continue from the last state whose output is complete
+    if state == "written" and not write_complete(written_path):
+        state = "vep_done"
+    if state == "vep_done" and not write_complete(sites_path):
+        state = "pending"
+    if state not in ("vep_done", "written"):
+        mt = vcfs_to_matrixtable(vcfpath.__str__(), write=False, annotate=False)
+        mt = mt.filter_rows(mt.alleles[1] != '*')  # These alleles break VEP, filter out star alleles.
+        with profiling.stage("write_vep_sites", sample=name):
+            run_vep(mt.rows().select(), vep_cache, vep_runner).select("vep").write(sites_path.__str__(),
+                                                                                    overwrite=True)
+        manifest.set_state(name, "vep_done")
+        state = "vep_done"
+    if state == "vep_done":
+        mt = vcfs_to_matrixtable(vcfpath.__str__(), write=False, annotate=False)
+        mt = mt.filter_rows(mt.alleles[1] != '*')
+        sites = hl.read_table(sites_path.__str__())
+        mt = mt.annotate_rows(vep=sites[mt.row_key].vep)
+        with profiling.stage("write_sample", sample=name):
+            project_table(append_table(mt, prefix, metadata=metadata)).write(written_path.__str__(), overwrite=True)
+        manifest.set_state(name, "written")
+    rows, columns = validate_matrixtable(written_path)
+    replace_folder(written_path, destination)
+    manifest.set_state(name, "validated", rows=rows, columns=columns)
+    shutil.rmtree(sites_path, ignore_errors=True)
+    return hl.read_matrix_table(destination.__str__())
+
+
+@profiling.timed()
+def write_gnomad_table(vcfs, dest, overwrite=False, metadata=None, af_edges=AF_BIN_EDGES, joint=False,
+                       batch_size=JOINT_BATCH_SIZE, vep_cache=None, union_options=None, resume=False,
+                       vep_runner=None):
+    """
+    Imports VCFs into dest (see import_sample, or vcfs_to_cohort_matrixtable if joint) and writes their frequency
+    table to dest/gnomad_tb, recording the progress in the ImportManifest of dest.
+    :param resume: Continue an interrupted import: unfinished samples continue from their last state and a
+    gnomad_tb already written from the same samples is read instead of aggregated again
+    :param vep_runner: VepRunner to run VEP with, its chunk cache is cleared once every sample is imported
+    :return: The frequency table
+    """
     hailtables = dict()
+    phenotypes = dict()
     metadata_dict = get_metadata(metadata)
+    manifest = ImportManifest(dest)
+    unfinished = manifest.unfinished()
+    if len(unfinished) > 0:
+        sys.stderr.write("{0} unfinished manifest entries in {1}, {2}\n".format(
+            len(unfinished), manifest.path, "resuming them" if resume else "starting them over"))
+    if joint:
+        # One sample indexed MatrixTable for the whole cohort, see vcfs_to_cohort_matrixtable
+        vcfs = sorted(vcfs)
+        destination = Path(dest).joinpath("cohort_mt")
+        inputs = [[vcfpath.__str__(), vcfpath.stat().st_size, vcfpath.stat().st_mtime_ns] for vcfpath in vcfs]
+        checksum = hashlib.sha256(json.dumps(inputs).encode("utf-8")).hexdigest()
+        entry = manifest.entries.get("cohort_mt", dict())
+        if not overwrite and len(entry) == 0 and write_complete(destination):
+            # Written before manifests, kept like the per sample tables of import_sample
+            rows, columns = validate_matrixtable(destination)
+            manifest.set_state("cohort_mt", "validated", checksum=checksum, samples=len(vcfs), rows=rows,
+                               columns=columns)
+            entry = manifest.entries["cohort_mt"]
+        if overwrite or entry.get("state") != "validated" or entry.get("checksum") != checksum \
+                or not destination.exists():
+            same = entry.get("checksum") == checksum
+            manifest.set_state("cohort_mt", "pending", checksum=checksum, samples=len(vcfs))
+            tmp = manifest.tmp_path("cohort_mt")
+            vcfs_to_cohort_matrixtable(vcfs, tmp, batch_size, metadata_dict, vep_cache, resume and same, vep_runner)
+            rows, columns = validate_matrixtable(tmp)
+            replace_folder(tmp, destination)
+            manifest.set_state("cohort_mt", "validated", rows=rows, columns=columns)
+        else:
+            sys.stderr.write("Overwrite is not active, opening existing file instead: {0}\n"
+                             .format(destination.__str__()))
+        hailtables["cohort_mt"] = hl.read_matrix_table(destination.__str__())
+        vcfs = []
     for vcfpath in vcfs:
         assert vcfpath.exists()
         prefix = file_utility.trim_prefix(vcfpath.stem)
-        destination = Path(dest).joinpath(vcfpath.stem)
-        if overwrite or not destination.exists():
-            # Read all vcfs and make a dict, keeps in memory!
-            hailtables[prefix] = append_table(vcfs_to_matrixtable(vcfpath.__str__(), destination.__str__(), False),
-                                              prefix, destination.__str__(), True, metadata_dict)
-        elif destination.exists():
-            hailtables[prefix] = hl.read_matrix_table(destination.__str__())
-            sys.stderr.write("Overwrite is not active, opening existing file instead: {0}\n"
-                             .format(destination.__str__()))
-        else:
-            FileExistsError("The output HailTable exists and --overwrite is not active in destination {0}"
-                            .format(destination.__str__()))
-
+        hailtables[prefix] = import_sample(manifest, vcfpath, metadata_dict, vep_cache, overwrite, resume,
+                                           vep_runner)
+        phenotypes[prefix] = sample_metadata(metadata_dict, prefix) + (Path(dest).joinpath(vcfpath.stem).__str__(),)
+    if len(phenotypes) > 0:
+        write_phenotype_index(dest, phenotypes)
+    if vep_runner is not None:
+        vep_runner.clear()
 
-# Turn MatrixTables into HailTables, keyed by gene, join
-    unioned_table = table_join(mts_to_table(list(hailtables.values())))
-
-    gnomad_tb = gnomad_table(unioned_table)
     gnomadpath = Path(dest).joinpath(Path("gnomad_tb"))
-    if gnomadpath.exists():
-        if not overwrite:
+    # The inputs of the manifest entry are those of the gnomad_tb in dest, they only change once it is replaced
+    inputs = {"samples": sorted(hailtables), "af_edges": list(af_edges)}
+    entry = manifest.entries.get("gnomad_tb", dict())
+    if resume and not overwrite and entry.get("state") == "validated" and entry.get("inputs") == inputs \
+            and write_complete(gnomadpath):
+        sys.stderr.write("{0} is up to date, reading it\n".format(gnomadpath))
+        return hl.read_table(gnomadpath.__str__())
+    if gnomadpath.exists() and not overwrite:
+        if not resume:
             raise FileExistsError(gnomadpath)
-        else:
-            stderr.write("WARNING: Overwrite is active. Deleting pre-existing directory {0}\n".format(gnomadpath))
-            shutil.rmtree(gnomadpath)
-    else:
-        gnomad_tb.write(gnomadpath.__str__())
-        pass
-    return gnomad_tb
+        if entry.get("inputs") != inputs:
+            raise FileExistsError("{0} was aggregated from other samples or MAX_AF bins than this import, --resume "
+                                  "only completes it, replace it with --overwrite".format(gnomadpath))
+    manifest.set_state("gnomad_tb", "pending")
+    # Turn MatrixTables into HailTables, keyed by gene, join
+    unioned_table = table_join(mts_to_table(list(hailtables.values())), **(union_options or {}))
+    tmp = manifest.tmp_path("gnomad_tb")
+    with profiling.stage("write_gnomad_tb", samples=len(hailtables)):
+        gnomad_table(unioned_table, af_edges).write(tmp.__str__(), overwrite=True)
+    manifest.set_state("gnomad_tb", "written")
+    if gnomadpath.exists() and overwrite:
+        stderr.write("WARNING: Overwrite is active. Replacing pre-existing directory {0}\n".format(gnomadpath))
+    elif gnomadpath.exists():
+        stderr.write("WARNING: Replacing {0} of the same samples and MAX_AF bins, the interrupted import was "
+                     "aggregating it again\n".format(gnomadpath))
+    replace_folder(tmp, gnomadpath)
+    manifest.set_state("gnomad_tb", "validated", inputs=inputs)
+    return hl.read_table(gnomadpath.__str__())
+
+@profiling.timed()
+def write_local_gnomad_tsv(vcfs, path, af_edges=AF_BIN_EDGES, workers=LOCAL_WORKERS):
+    """
+    Readvcfs without Spark (--engine local) for small cohorts: streams the VEP annotated VCFs with local_engine,
+    applying append_table and project_table to every entry, and writes the TSV that
+    gnomad_table(...).flatten().export(path) writes on the Hail path. The impact, gene and MAX_AF come from the CSQ
+    annotation of the VCFs, VEP is not run, and no MatrixTables are written. benchmark.py --compare-engines checks
+    that both engines write the same file.
+    :param workers: VCF reading processes
+    """
+    counts = local_engine.cohort_counts(vcfs, IMPACTS, af_edges, workers)
+    local_engine.write_tsv(counts, path, IMPACTS, af_bin_names(af_edges))
+    sys.stderr.write("Wrote {0} gene(s) to {1}\n".format(len(counts), path))
+
+
+def collect_vcfs(paths):
+    """
+    :param paths: VCF files, lists of VCF paths (.txt/.list) or folders containing VCF files
+    :return: set of VCF Paths
+    """
+    files = set()
+    for path in [Path(path) for path in paths]:
+        if path.is_file():
+            if path.suffix ==".vcf":  # VCF files are parsed.
+                files.add(path)
+            else:  # might be a list of VCFs
+                with open(path, "r") as filelist:
+                    for line in filelist:
+                        # coerce lines into path
+                        p = Path(line.strip())
+                        if p.suffix == ".vcf":
+                            files.add(p)
+        else:  # Glob folder for *.VCF
+            files |= set(path.glob("*.vcf"))
+    return files
+
 
 def _not(func):
     """
@@ -249,7 +963,61 @@ def _not(func):
     def not_func(*args, **kwargs):
         return not func(*args, **kwargs)
     return not_func
-def load_hailtables(dest, number, out=None, metadata=None, overwrite=False, phenotype=None):
+def discover_sample_folders(dest, number=-1, phenotype=None, index=None):
+    """
+    Lists the MatrixTable folders of dest once and selects the ones to open, without opening any: samples the
+    phenotype index rules out are dropped (samples missing from the index are kept, their phenotype is only known
+    once opened) and then the first number folders by name are kept. The cohort MatrixTable of Readvcfs --joint
+    (prefix cohort_mt) is only used when dest holds no per sample tables, the two hold the same samples.
+    :param number: Number of tables to keep, -1 keeps all
+    :param phenotype: Phenotype regex, None keeps all
+    :param index: Phenotype index, see read_phenotype_index
+    :return: dict of prefix -> folder
+    """
+    index = index or dict()
+    folders = _sample_folders(dest)
+    cohort = Path(dest).joinpath("cohort_mt")
+    if cohort.is_dir() and len(folders) == 0:
+        folders = {"cohort_mt": cohort}
+    elif cohort.is_dir():
+        sys.stderr.write("WARNING: Leaving out {0}, the per sample tables of {1} are used instead so that no sample "
+                         "is counted twice\n".format(cohort, dest))
+    sys.stderr.write("{0} MatrixTable folder(s) in {1}\n".format(len(folders), str(dest)))
+    if phenotype is not None:
+        folders = {prefix: folder for prefix, folder in folders.items()
+                   if prefix not in index or re.search(phenotype, index[prefix][0]) is not None}
+        sys.stderr.write("{0} folder(s) left after the phenotype index\n".format(len(folders)))
+    if number is not None and number != -1:
+        folders = dict(list(folders.items())[:number])
+    return folders
+
+
+def open_matrixtables(folders, workers=READ_WORKERS):
+    """
+    Opens MatrixTables with a thread pool, reading their metadata concurrently, and reports the progress.
+    :param folders: dict of prefix -> folder
+    :param workers: Threads
+    :return: dict of prefix -> MatrixTable in the order of folders
+    """
+    opened = dict()
+    if len(folders) == 0:
+        return opened
+    start = datetime.datetime.now()
+    step = max(1, len(folders) // 20)
+    sys.stderr.write("Opening {0} MatrixTable(s) with {1} thread(s)\n".format(len(folders), workers))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(hl.read_matrix_table, folder.__str__()): prefix for prefix, folder in folders.items()}
+        for done, future in enumerate(as_completed(futures), 1):
+            opened[futures[future]] = future.result()
+            if done % step == 0 or done == len(folders):
+                sys.stderr.write("Opened {0}/{1} MatrixTables ({2}%), {3}\n".format(
+                    done, len(folders), done * 100 // len(folders), datetime.datetime.now() - start))
+    return {prefix: opened[prefix] for prefix in folders}
+
+
+@profiling.timed()
+def load_hailtables(dest, number, out=None, metadata=None, overwrite=False, phenotype=None, af_edges=AF_BIN_EDGES,
+                    union_options=None, gene_layout=False):
     hailtables = dict()
     gnomadpath = Path(dest).joinpath(Path("gnomad_tb", str(unique)))
     ### TODO: Remove temporary fix
@@ -257,66 +1025,50 @@ def load_hailtables(dest, number, out=None, metadata=None, overwrite=False, phen
     ecode_phenotype = dict()
     inverse_matches = dict()
     ###
-    count = sum(1 for t in dest.iterdir())
-    sys.stderr.write("{0} items in folder {1}\n".format(count, str(dest)))
-    i = 0
-    toolbar_width = 1 if count//10 == 0 else count//10
-    # setup toolbar
-    sys.stderr.write("Loading MatrixTables\n Progress\n")
-
-    for idx, folder in enumerate(dest.iterdir(), 1):
-        if folder.is_dir():
-            vcfname = folder.name
-            outpath = Path(out).joinpath(vcfname)
-            #print(vcfname)
-            if vcfname.rfind("gnomad_tb") == -1:  # Skip the folders containing the end product
-                prefix = file_utility.trim_prefix(vcfname)
-                mt_a = hl.read_matrix_table(folder.__str__())
-                #mt_a.cache()
-                if metadata is not None:
-                    # mt_a.write(outpath.__str__()) #Hail scripts in here fix loaded MatrixTables
-                    # and outputs into new args.out
-                   #mt_a.drop('phenotype')
-                    #phen, mut = metadata.get(prefix, ["NA", "NA"])
-                    #mt_a = mt_a.annotate_globals(metadata=hl.struct(phenotype=phen, mutation=mut))
-                    #mt_a.write(outpath.__str__())
-                    #mt_a.describe()
-
-                    pass
-                hailtables[prefix] = mt_a
-                if idx//toolbar_width >= i:
-                    sys.stderr.write("[{0}] Done {1}%\n".format("x"*(toolbar_width//10)*(i)+"-"*(toolbar_width//10)*(10-i), idx//toolbar_width*10))
-                    i+=1
-
-    # TODO: Slicing
+    index = read_phenotype_index(dest)
+    if phenotype is not None and len(index) == 0:
+        sys.stderr.write("WARNING: No {0} in {1}, every MatrixTable is opened to read its phenotype\n"
+                         .format(PHENOTYPE_INDEX, dest))
+    folders = discover_sample_folders(dest, number, phenotype, index)
+    hailtables = open_matrixtables(folders)
     print("Read {0} HailTables".format(len(hailtables.values())))
-    if number == -1:
-        number = len(hailtables)
     if phenotype is not None:
         # Union HailTables with a given phenotype, thereby filtering
         sys.stderr.write("Filtering tables based on phenotype \"{0}\"\n".format(phenotype))
-        for key, ht in hailtables.items():
-            #ecode_phenotype[key] = hl.eval(ht.metadata.phenotype)
-            #TODO: Load phenotypes once to increase speed of dict searches
-            pass
-
-        #matched_tables = list(filter(lambda k, t: t.startswith(phenotype), ecode_phenotype.items()))
-        matched_tables = list(filter(lambda t: hl.eval(t.metadata.phenotype.matches(phenotype)),
-                    hailtables.values()))
+        # Indexed samples were already matched in Python (re.search, like Hail's matches), only samples missing
+        # from the index need a Hail evaluation
+        matched_tables = {prefix: t for prefix, t in hailtables.items() if prefix != "cohort_mt"
+                          and (prefix in index or hl.eval(t.metadata.phenotype.matches(phenotype)))}
+        tables = entry_tables(dest, matched_tables, gene_layout) if len(matched_tables) > 0 else []
+        cohort = hailtables.get("cohort_mt")
+        if cohort is not None:
+            # The phenotype of a cohort sample is a column field, the cohort is filtered column wise. The filtered
+            # cohort is not written to the gene layout, which holds the whole cohort.
+            if "metadata" not in cohort.col:
+                raise KeyError("The cohort MatrixTable has no sample metadata, import it with Readvcfs --globals")
+            cohort = cohort.filter_cols(cohort.metadata.phenotype.matches(phenotype))
+            if cohort.count_cols() > 0:
+                matched_tables["cohort_mt"] = cohort
+                tables += mts_to_table([cohort])
         if len(matched_tables) > 0:
             sys.stderr.write("Found {0} matching table(s) with given phenotype key\n".format(len(matched_tables)))
-            unioned_table = table_join(mts_to_table(matched_tables))
+            unioned_table = table_join(tables, **(union_options or {}))
         else:
             sys.stderr.write("NO tables matched to phenotype \"{0}\"\n".format(phenotype))
-            phens = list(hl.eval(t.metadata.phenotype) for t in hailtables.values())
+            phens = sorted(set(phen for phen, mut, path in index.values())) + \
+                list(hl.eval(t.metadata.phenotype) for prefix, t in hailtables.items()
+                     if prefix not in index and prefix != "cohort_mt")
+            if "cohort_mt" in hailtables:
+                phens += sorted(hailtables["cohort_mt"].aggregate_cols(
+                    hl.agg.collect_as_set(hailtables["cohort_mt"].metadata.phenotype)))
             raise KeyError("Phenotype keys available: {0}".format(phens))
     else:
         # Else union all tables
-        unioned_table = table_join(mts_to_table(list(hailtables.values())))
+        unioned_table = table_join(entry_tables(dest, hailtables, gene_layout), **(union_options or {}))
         #sys.stderr.write("Writing intermediary unioned table to {0}\n".format(gnomadpath.parent.__str__() + "\gnomad_tb_unioned" + str(unique)))
         #unioned_table.write(gnomadpath.parent.__str__() + "\gnomad_tb_unioned" + str(unique))
 
-    gnomad_tb = gnomad_table(unioned_table)
+    gnomad_tb = gnomad_table(unioned_table, af_edges)
     if gnomadpath.exists():
         if not overwrite:
             raise FileExistsError(gnomadpath)
@@ -330,6 +1082,101 @@ def load_hailtables(dest, number, out=None, metadata=None, overwrite=False, phen
     return gnomad_tb
 
 
+def _sample_folders(dest):
+    # Per sample MatrixTable folders of a Readvcfs destination by prefix
+    return {file_utility.trim_prefix(folder.name): folder for folder in sorted(Path(dest).iterdir())
+            if folder.is_dir() and folder.name.rfind("gnomad_tb") == -1
+            and folder.name not in (INCREMENTAL_STORE, GENE_LAYOUT, IMPORT_TMP, "cohort_mt")}
+
+
+def _read_manifest(store):
+    path = store.joinpath("manifest.json")
+    if not path.exists():
+        return {"version": 0, "af_edges": None, "sums": None, "samples": dict(), "excluded": []}
+    with path.open() as f:
+        return json.load(f)
+
+
+def _write_manifest(store, manifest):
+    # Replaced atomically, the manifest always points to a complete sums table
+    tmp = store.joinpath("manifest.json.tmp")
+    with tmp.open("w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, store.joinpath("manifest.json"))
+
+
+@profiling.timed()
+def update_gnomad_table(dest, store=None, remove=(), replace=(), af_edges=AF_BIN_EDGES, union_options=None):
+    """
+    Incremental Loaddb. The store keeps the gene level sums of every included sample (gnomad_table with entry
+    counts), each sample's own contribution and a manifest of the included prefixes. Samples found in dest that
+    are not in the manifest are added, removed samples have their stored contribution subtracted (and are not added
+    back while their folder exists) and replaced samples are subtracted and added again from their current
+    MatrixTable, which also brings back a removed sample. Only the changed samples are read.
+    :param dest: Folder of per sample MatrixTables, as written by Readvcfs
+    :param store: Store folder, defaults to dest/INCREMENTAL_STORE
+    :param remove: Prefixes to remove
+    :param replace: Prefixes to recompute
+    :param af_edges: MAX_AF bin edges, must match the store
+    :param union_options: Keyword arguments of table_join, which unions the stored sums and the contributions
+    :return: Table keyed by gene, the updated frequency table
+    """
+    dest = Path(dest)
+    store = dest.joinpath(INCREMENTAL_STORE) if store is None else Path(store)
+    store.mkdir(parents=True, exist_ok=True)
+    manifest = _read_manifest(store)
+    if manifest["af_edges"] is not None and manifest["af_edges"] != list(af_edges):
+        raise ValueError("The store {0} uses the MAX_AF bins {1}, rebuild it to use {2}"
+                         .format(store, manifest["af_edges"], list(af_edges)))
+    samples, excluded = manifest["samples"], set(manifest["excluded"])
+    folders = _sample_folders(dest)
+    unknown = [prefix for prefix in remove if prefix not in samples] + \
+              [prefix for prefix in replace if prefix not in samples and prefix not in excluded]
+    if len(unknown) > 0:
+        raise KeyError("Samples not in the store {0}: {1}".format(store, unknown))
+    missing = [prefix for prefix in replace if prefix not in folders]
+    if len(missing) > 0:
+        raise FileNotFoundError("No MatrixTable to replace the samples {0} from in {1}".format(missing, dest))
+    subtracted = [prefix for prefix in dict.fromkeys(list(remove) + list(replace)) if prefix in samples]
+    added = [prefix for prefix in folders
+             if (prefix not in samples and prefix not in excluded) or prefix in replace]
+    sys.stderr.write("{0} sample(s) in the store, adding {1}, removing {2}, replacing {3}\n".format(
+        len(samples), len([prefix for prefix in added if prefix not in replace]), len(remove), len(replace)))
+    if len(added) == 0 and len(subtracted) == 0:
+        sys.stderr.write("The store is up to date\n")
+        return hl.read_table(store.joinpath(manifest["sums"]).__str__()).drop("entries")
+
+    version = manifest["version"] + 1
+    contributions = dict()
+    for prefix in added:
+        # Contribution of one sample, stored so that it can be subtracted without its MatrixTable
+        path = "contributions/{0}_{1:06d}.ht".format(prefix, version)
+        tb = mts_to_table([hl.read_matrix_table(folders[prefix].__str__())])[0]
+        gnomad_table(tb, af_edges, count_entries=True).write(store.joinpath(path).__str__(), overwrite=True)
+        contributions[prefix] = path
+    old = [hl.read_table(store.joinpath(manifest["sums"]).__str__())] if manifest["sums"] is not None else []
+    new = [hl.read_table(store.joinpath(path).__str__()) for path in contributions.values()]
+    subtract = [hl.read_table(store.joinpath(samples[prefix]["contribution"]).__str__()) for prefix in subtracted]
+    if len(old) + len(new) == 0:
+        raise Exception("No tables to be joined based on current configuration.")
+    sums = "sums_{0:06d}.ht".format(version)
+    merge_gnomad_tables(old + new, subtract, af_edges, union_options).write(store.joinpath(sums).__str__(), overwrite=True)
+
+    stale = ([manifest["sums"]] if manifest["sums"] is not None else []) + \
+            [samples[prefix]["contribution"] for prefix in subtracted]
+    for prefix in remove:
+        del samples[prefix]
+    for prefix, path in contributions.items():
+        samples[prefix] = {"source": folders[prefix].__str__(), "contribution": path}
+    excluded = sorted((excluded | set(remove)) - set(contributions))
+    _write_manifest(store, {"version": version, "af_edges": list(af_edges), "sums": sums, "samples": samples,
+                            "excluded": excluded})
+    for path in stale:
+        shutil.rmtree(store.joinpath(path), ignore_errors=True)
+    sys.stderr.write("Store {0} now holds {1} sample(s)\n".format(store, len(samples)))
+    return hl.read_table(store.joinpath(sums).__str__()).drop("entries")
+
+
 if __name__ == '__main__':
     try:
 
@@ -352,10 +1199,39 @@ if __name__ == '__main__':
                               nargs='?', const=os.path.abspath("."))
         readvcfs.add_argument("-r", "--overwrite", help="Overwrites any existing output MatrixTables, HailTables.",
                               action="store_true")
+        readvcfs.add_argument("--resume", help="Continue an interrupted import from the states in <dest>/{0}, "
+                                               "finished samples are skipped.".format(IMPORT_MANIFEST),
+                              action="store_true")
         readvcfs.add_argument("-g", "--globals", help="Tab delimited input file containing globals string "
                                                       "for a given unique sample "
                                                       "(e.g. Identifier\\t.Phenotype\\tMutations", action="store",
                               type=str)
+        readvcfs.add_argument("-j", "--joint", help="Import the VCFs as one sample indexed cohort MatrixTable and run "
+                                                    "VEP once over its distinct sites.", action="store_true")
+        readvcfs.add_argument("--batch-size", help="VCFs per checkpointed batch of --joint.", type=int,
+                              default=JOINT_BATCH_SIZE)
+        readvcfs.add_argument("--vep-cache", help="Directory of the site level VEP annotation cache, only sites "
+                                                  "missing from it are sent to VEP.", type=str)
+        readvcfs.add_argument("--vep-workers", help="Run VEP outside of Hail over chunks of the distinct sites with "
+                                                    "this many VEP processes at once.", type=int)
+        readvcfs.add_argument("--vep-chunk-size", help="Sites per VEP process of --vep-workers.", type=int,
+                              default=vep_runner.VEP_CHUNK_SIZE)
+        readvcfs.add_argument("--vep-fork", help="VEP --fork of every --vep-workers process.", type=int,
+                              default=vep_runner.VEP_FORK)
+        readvcfs.add_argument("--vep-retries", help="Attempts of a failed --vep-workers chunk after the first.",
+                              type=int, default=vep_runner.VEP_RETRIES)
+        readvcfs.add_argument("--union-group-size", help="Tables unioned at once, the tables are joined as a tree "
+                                                         "of such unions.", type=int, default=UNION_GROUP_SIZE)
+        readvcfs.add_argument("--union-checkpoints", help="Folder to checkpoint every union level to.", type=str)
+        readvcfs.add_argument("--union-partitions", help="Repartition every union level to this many partitions.",
+                              type=int)
+        readvcfs.add_argument("--af-bins", help="Comma separated inner MAX_AF bin edges of the frequency table "
+                                                "(default 0.01,0.05).", type=parse_af_edges, default=AF_BIN_EDGES)
+        readvcfs.add_argument("--engine", help="hail, or local to build gnomad.tsv from the CSQ annotation of the VCFs "
+                                               "without Spark (no MatrixTables, VEP, --joint or --resume).",
+                              choices=["hail", "local"], default="hail")
+        readvcfs.add_argument("--workers", help="VCF reading processes of --engine local (default {0})."
+                              .format(LOCAL_WORKERS), type=int, default=LOCAL_WORKERS)
         loaddb = subparsers.add_parser("Loaddb", help="Load a folder containing HailTables.")
         loaddb.add_argument("-d", "--directory", help="Folder to load the Hail MatrixTable files from.",
                             nargs='?', const=os.path.abspath("."))
@@ -370,6 +1246,32 @@ if __name__ == '__main__':
         loaddb.add_argument("--phenotype", help="Filter a subset of samples with given phenotype. "
                                                 "Regex strings accepted e.g. r'NA\d+", action="store",
                             type=str)
+        loaddb.add_argument("--af-bins", help="See Readvcfs --af-bins.", type=parse_af_edges, default=AF_BIN_EDGES)
+        loaddb.add_argument("--union-group-size", help="See Readvcfs --union-group-size.", type=int,
+                            default=UNION_GROUP_SIZE)
+        loaddb.add_argument("--union-checkpoints", help="See Readvcfs --union-checkpoints.", type=str)
+        loaddb.add_argument("--union-partitions", help="See Readvcfs --union-partitions.", type=int)
+        loaddb.add_argument("--gene-layout", help="Collate from the gene sorted, equally partitioned per sample tables "
+                                                  "in <directory>/{0}, writing the missing ones first."
+                            .format(GENE_LAYOUT), action="store_true")
+        update = subparsers.add_parser("Update", help="Incrementally update the frequency table of a folder of "
+                                                      "MatrixTables, only reading added, removed or replaced samples.")
+        update.add_argument("-d", "--directory", help="Folder to load the Hail MatrixTable files from.",
+                            nargs='?', const=os.path.abspath("."))
+        update.add_argument("-s", "--store", help="Folder of the stored sums and manifest "
+                                                  "(default <directory>/{0}).".format(INCREMENTAL_STORE), type=str)
+        update.add_argument("-o", "--out", help="Output destination.", action="store", type=str, required=True)
+        update.add_argument("--remove", help="Sample prefixes to subtract from the table.", nargs="+", default=[])
+        update.add_argument("--replace", help="Sample prefixes to recompute from their current MatrixTable.",
+                            nargs="+", default=[])
+        update.add_argument("--af-bins", help="See Readvcfs --af-bins.", type=parse_af_edges, default=AF_BIN_EDGES)
+        update.add_argument("--union-group-size", help="See Readvcfs --union-group-size.", type=int,
+                            default=UNION_GROUP_SIZE)
+        update.add_argument("--union-checkpoints", help="See Readvcfs --union-checkpoints.", type=str)
+        update.add_argument("--union-partitions", help="See Readvcfs --union-partitions.", type=int)
+        for command in (readvcfs, loaddb, update):
+            resources.add_arguments(command)
+            profiling.add_arguments(command)
 
         args = parser.parse_args()
         if args.command is not None:
@@ -384,61 +1286,75 @@ if __name__ == '__main__':
                 # Regex in files matching only with a matching regex (e.g. *.vep.vcf wildcard).
                 # Unique files only, duplicates written to duplicates_*.txt
 
+            elif str.lower(args.command) == "readvcfs" and args.engine == "local":
+                profiling.configure(args.report, args.trace, args.report_counts)
+                write_local_gnomad_tsv(collect_vcfs(args.file), Path(args.dest).parent.joinpath("gnomad.tsv"),
+                                       args.af_bins, args.workers)
             else:
-                conf = SparkConf()
-                conf.set('spark.sql.files.maxPartitionBytes', '60000000000')
-                conf.set('spark.sql.files.openCostInBytes', '60000000000')
-                conf.set('spark.submit.deployMode', u'client')
-                conf.set('spark.app.name', u'HailTools-TSHC')
-                conf.set('spark.executor.memory', "4g")
-                conf.set('spark.driver.memory', "56g")
-                conf.set("spark.jars", "{0}/backend/hail-all-spark.jar".format(hail_home))
-                conf.set("spark.executor.extraClassPath", "./hail-all-spark.jar")
-                conf.set("spark.driver.extraClassPath", "{0}/backend/hail-all-spark.jar".format(hail_home))
-                conf.set("spark.serializer", "org.apache.spark.serializer.KryoSerializer")
-                conf.set("spark.kryo.registrator", "is.hail.kryo.HailKryoRegistrator")
-                conf.set("spark.driver.bindAddress", "127.0.0.1")
-                conf.set("spark.local.dir", "{0}".format(args.out))
-                sc = SparkContext(conf=conf)
-                hl.init(backend="spark", sc=sc, min_block_size=128)
                 if str.lower(args.command) == "readvcfs":
-                    full_paths = [Path(path) for path in args.file]
-                    files = set()
-                    for path in full_paths:
-                        if path.is_file():
-                            if path.suffix ==".vcf":  # VCF files are parsed.
-                                files.add(path)
-                            else:  # might be a list of VCFs
-                                with open(path, "r") as filelist:
-                                    for line in filelist:
-                                        # coerce lines into path
-                                        p = Path(line.strip())
-                                        if p.suffix == ".vcf":
-                                            files.add(p)
-                        else:  # Glob folder for *.VCF
-                            files |= set(path.glob("/*.vcf"))
+                    files = collect_vcfs(args.file)
+                    inputs = files
+                else:
+                    inputs = [args.directory] if args.directory is not None else []
+                settings = resources.resolve(resources.load_profile(args.profile, args.resources),
+                                             *resources.input_size(inputs), cores=args.cores, memory_gb=args.memory,
+                                             partition_mb=args.partition_mb, tmp_dir=args.tmp_dir)
+                if args.dry_run:
+                    print(resources.describe(settings))
+                    sys.exit(0)
+                profiling.configure(args.report, args.trace, args.report_counts)
+                with profiling.stage("spark_init", profile=args.profile):
+                    conf = SparkConf()
+                    conf.set('spark.submit.deployMode', u'client')
+                    conf.set('spark.app.name', u'HailTools-TSHC')
+                    conf.set("spark.jars", "{0}/backend/hail-all-spark.jar".format(hail_home))
+                    conf.set("spark.executor.extraClassPath", "./hail-all-spark.jar")
+                    conf.set("spark.driver.extraClassPath", "{0}/backend/hail-all-spark.jar".format(hail_home))
+                    conf.set("spark.serializer", "org.apache.spark.serializer.KryoSerializer")
+                    conf.set("spark.kryo.registrator", "is.hail.kryo.HailKryoRegistrator")
+                    conf.set("spark.driver.bindAddress", "127.0.0.1")
+                    for key, value in settings["spark"].items():
+                        conf.set(key, value)
+                    sc = SparkContext(conf=conf)
+                    hl.init(backend="spark", sc=sc, min_block_size=settings["min_block_size"],
+                            tmp_dir=settings["tmp_dir"], local_tmpdir=settings["tmp_dir"])
+                if str.lower(args.command) in ("readvcfs", "loaddb", "update"):
+                    union_options = dict(group_size=args.union_group_size, checkpoint_dir=args.union_checkpoints,
+                                         partitions=args.union_partitions)
+                if str.lower(args.command) == "readvcfs":
+                    runner = None
+                    if args.vep_workers is not None:
+                        # Chunk results are kept in the destination, a failed run retries only its failed chunks
+                        runner = vep_runner.VepRunner(VEP_CONFIG, Path(args.dest).joinpath(IMPORT_TMP, "vep_chunks"),
+                                                      args.vep_chunk_size, args.vep_workers, args.vep_fork,
+                                                      args.vep_retries)
                     gnomad_path = Path(args.dest).joinpath(Path("gnomad_tb"))
-                    if gnomad_path.exists():
-                        if args.overwrite:
-                            gnomad_tb = write_gnomad_table(files, args.dest, overwrite=args.overwrite,
-                                                           metadata=args.globals)
-                        else:
-                            FileExistsError("The combined gnomad_tb exists and --overwrite is not active! "
-                                            "Rename or move the folder {0}".format(gnomad_path.__str__()))
-                    else:
-                        gnomad_tb = write_gnomad_table(files, args.dest, overwrite=args.overwrite,
-                                                       metadata=args.globals)
+                    if gnomad_path.exists() and not args.overwrite and not args.resume:
+                        raise FileExistsError("The combined gnomad_tb exists and neither --overwrite nor --resume is "
+                                              "active! Rename or move the folder {0}".format(gnomad_path.__str__()))
+                    gnomad_tb = write_gnomad_table(files, args.dest, overwrite=args.overwrite, metadata=args.globals,
+                                                   af_edges=args.af_bins, joint=args.joint, batch_size=args.batch_size,
+                                                   vep_cache=args.vep_cache, union_options=union_options,
+                                                   resume=args.resume, vep_runner=runner)
                     #gnomad_tb.describe()
-                    gnomad_tb.flatten().export(Path(args.dest).parent.joinpath("gnomad.tsv").__str__())
+                    with profiling.stage("export"):
+                        gnomad_tb.flatten().export(Path(args.dest).parent.joinpath("gnomad.tsv").__str__())
                 elif str.lower(args.command) == "loaddb":
                     metadata_dict = None
                     if args.globals is not None:
                         metadata_dict = get_metadata(args.globals)
 
                     dirpath = Path(args.directory)
-                    gnomad_tb = load_hailtables(dirpath, args.number, args.out, metadata_dict, args.overwrite, args.phenotype)
+                    gnomad_tb = load_hailtables(dirpath, args.number, args.out, metadata_dict, args.overwrite, args.phenotype,
+                                                args.af_bins, union_options, args.gene_layout)
                     gnomad_tb.describe()
-                    gnomad_tb.flatten().export(Path(args.out).parent.joinpath("gnomad_tb{0}.tsv".format(unique)).__str__())
+                    with profiling.stage("export"):
+                        gnomad_tb.flatten().export(Path(args.out).parent.joinpath("gnomad_tb{0}.tsv".format(unique)).__str__())
+                elif str.lower(args.command) == "update":
+                    gnomad_tb = update_gnomad_table(Path(args.directory), args.store, args.remove, args.replace,
+                                                    args.af_bins, union_options)
+                    with profiling.stage("export"):
+                        gnomad_tb.flatten().export(Path(args.out).parent.joinpath("gnomad_tb{0}.tsv".format(unique)).__str__())
         else:
             # No valid command
             parser.print_usage()
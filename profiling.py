@@ -0,0 +1,219 @@
+import atexit
+import functools
+import json
+import os
+import threading
+import time
+
+# Seconds between the driver memory samples taken while a stage is open
+SAMPLE_SECONDS = 0.5
+
+
+def _rss_mb(pid):
+    # Resident set size of a process from /proc, None where it can't be read
+    try:
+        with open("/proc/{0}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        return None
+    return None
+
+
+def _spark_context():
+    try:
+        from pyspark import SparkContext
+    except ImportError:
+        return None
+    return SparkContext._active_spark_context
+
+
+def _spark_jobs():
+    # IDs of the Spark jobs known to the status tracker, Hail's jobs are not in a job group
+    sc = _spark_context()
+    if sc is None:
+        return None
+    return set(sc.statusTracker().getJobIdsForGroup())
+
+
+def _jvm_pid():
+    # In local mode the Spark driver is the JVM started by pyspark
+    try:
+        return _spark_context()._gateway.proc.pid
+    except AttributeError:
+        return None
+
+
+def _table_stats(result):
+    # Rows and partitions of a Hail Table or MatrixTable, counting evaluates it
+    if hasattr(result, "count_rows"):
+        rows = result.count_rows()
+    elif hasattr(result, "n_partitions"):
+        rows = result.count()
+    else:
+        return dict()
+    return {"rows": rows, "partitions": result.n_partitions()}
+
+
+class RunReport():
+    """
+    Stage timings of a run. Each stage records its wall time, the peak resident memory of the Python process and
+    of the driver JVM while it was open (sampled every SAMPLE_SECONDS), the Spark jobs started meanwhile and,
+    with counts, the rows and partitions of its result. Stages nest, a stage opened inside another one (on the
+    same thread) has it as parent. Finished stages are appended to the JSON lines file path as they close, so an
+    interrupted run keeps its report, and all of them are written as a Chrome trace (chrome://tracing, Perfetto)
+    to trace when the run ends.
+    Hail evaluates lazily: a stage building a Table only takes the time of the query plan unless counts is set,
+    the work shows up in the stage that writes or counts the Table.
+    """
+    def __init__(self, path=None, trace=None, counts=False):
+        self.path = path
+        self.trace = trace
+        self.counts = counts
+        self.records = []
+        self._open = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    def _sample(self):
+        python, jvm = _rss_mb(os.getpid()), None
+        pid = _jvm_pid()
+        if pid is not None:
+            jvm = _rss_mb(pid)
+        with self._lock:
+            for record in self._open:
+                for key, value in (("python_rss_peak_mb", python), ("jvm_rss_peak_mb", jvm)):
+                    if value is not None and (record[key] is None or value > record[key]):
+                        record[key] = value
+
+    def _run_sampler(self):
+        while True:
+            time.sleep(SAMPLE_SECONDS)
+            with self._lock:
+                if len(self._open) == 0:
+                    self._sampler = None
+                    return
+            self._sample()
+
+    def _start(self, name, fields):
+        stack = self._local.__dict__.setdefault("stack", [])
+        with self._lock:
+            record = {"stage": name, "id": len(self.records) + len(self._open),
+                      "parent": stack[-1]["id"] if len(stack) > 0 else None, "thread": threading.get_ident(),
+                      "start": time.time(), "seconds": None, "python_rss_peak_mb": None, "jvm_rss_peak_mb": None,
+                      "spark_jobs": None}
+            record.update(fields)
+            self._open.append(record)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._run_sampler, daemon=True)
+                self._sampler.start()
+        stack.append(record)
+        self._sample()
+        return record
+
+    def _end(self, record, jobs, started, error=None):
+        self._sample()
+        record["seconds"] = time.perf_counter() - started
+        after = _spark_jobs()
+        if jobs is not None and after is not None:
+            record["spark_jobs"] = sorted(after - jobs)
+        if error is not None:
+            record["error"] = type(error).__name__
+        self._local.stack.pop()
+        with self._lock:
+            self._open.remove(record)
+            self.records.append(record)
+            if self.path is not None:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def stage(self, name, **fields):
+        """
+        Context manager timing a stage, yields the record of the stage so that values (e.g. rows) can be added to
+        it. Extra keyword arguments are added to the record.
+        """
+        return _Stage(self, name, fields)
+
+    def write_trace(self, path=None):
+        path = path or self.trace
+        if path is None:
+            return
+        events = []
+        for record in sorted(self.records, key=lambda r: r["start"]):
+            args = {key: value for key, value in record.items()
+                    if key not in ("stage", "start", "seconds", "thread") and value is not None}
+            events.append({"name": record["stage"], "ph": "X", "ts": int(record["start"] * 1e6),
+                           "dur": int(record["seconds"] * 1e6), "pid": os.getpid(), "tid": record["thread"],
+                           "args": args})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+class _Stage():
+    def __init__(self, report, name, fields):
+        self.report = report
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.jobs = _spark_jobs()
+        self.started = time.perf_counter()
+        self.record = self.report._start(self.name, self.fields)
+        return self.record
+
+    def __exit__(self, exc_type, exc, tb):
+        self.report._end(self.record, self.jobs, self.started, exc)
+        return False
+
+
+# Report of the current run, see configure
+report = RunReport()
+
+
+def configure(path=None, trace=None, counts=False):
+    """
+    Starts a new run report, written to path (JSON lines) and trace (Chrome trace, once the process exits).
+    """
+    global report
+    report = RunReport(path, trace, counts)
+    if trace is not None:
+        atexit.register(report.write_trace)
+    return report
+
+
+def stage(name, **fields):
+    """
+    Times a stage in the current run report, see RunReport.stage.
+    """
+    return report.stage(name, **fields)
+
+
+def timed(name=None):
+    """
+    Decorator timing every call of a function as a stage of the current run report, named after the function
+    unless name is given. With counts, the rows and partitions of a returned Table or MatrixTable are recorded.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with report.stage(name or func.__name__) as record:
+                result = func(*args, **kwargs)
+                if report.counts:
+                    record.update(_table_stats(result))
+                return result
+        return wrapper
+    return decorator
+
+
+def add_arguments(parser):
+    """
+    Adds the run report options to an argparse (sub)parser.
+    """
+    parser.add_argument("--report", help="Append the timings of the pipeline stages to this JSON lines file.",
+                        type=str)
+    parser.add_argument("--trace", help="Write the stage timings as a Chrome trace (chrome://tracing) to this file.",
+                        type=str)
+    parser.add_argument("--report-counts", help="Count the rows and partitions of every timed stage result. Forces "
+                                                "each stage to be evaluated on its own, slower.", action="store_true")
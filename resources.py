@@ -0,0 +1,141 @@
+import json
+import math
+import os
+import tempfile
+from pathlib import Path
+
+# Built-in resource profiles, values left out are derived from the host and the input size. A profile of the
+# --resources JSON file ({"profiles": {name: {...}}}) with the same name replaces the built-in one.
+#   cores: Local mode threads, memory_gb: Driver memory, memory_fraction: Share of the RAM for the driver when
+#   memory_gb is not set, partition_mb: Target input partition size, tmp_dir: Spark and Hail temporary files,
+#   spark: Extra Spark settings
+PROFILES = {
+    "auto": {},
+    "small": {"memory_fraction": 0.5, "partition_mb": 64},
+    "server": {"memory_fraction": 0.85, "partition_mb": 256},
+    # The settings used before profiles existed, one partition per file
+    "legacy": {"memory_gb": 56, "partition_mb": 128,
+               "spark": {"spark.executor.memory": "4g", "spark.sql.files.maxPartitionBytes": "60000000000",
+                         "spark.sql.files.openCostInBytes": "60000000000"}},
+}
+DEFAULT_PROFILE = "auto"
+DEFAULT_MEMORY_FRACTION = 0.8
+DEFAULT_PARTITION_MB = 128
+# Memory left to the OS and the Python process however large the memory fraction
+RESERVED_MEMORY_GB = 2
+# Small files are packed into one partition up to this many bytes, see spark.sql.files.openCostInBytes
+OPEN_COST_BYTES = 4 * 1024 * 1024
+
+
+def detect_cores():
+    return os.cpu_count() or 1
+
+
+def detect_memory_gb():
+    """
+    :return: Physical memory in GB, None where it can't be read
+    """
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 3
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def input_size(paths):
+    """
+    :param paths: Input files and folders (e.g. MatrixTables)
+    :return: tuple of (total bytes, number of inputs)
+    """
+    total = 0
+    count = 0
+    for path in paths:
+        path = Path(path)
+        if path.is_file():
+            total += path.stat().st_size
+            count += 1
+        elif path.is_dir():
+            count += 1
+            for dirpath, dirnames, files in os.walk(path):
+                total += sum(os.path.getsize(os.path.join(dirpath, name)) for name in files)
+    return total, count
+
+
+def load_profile(name=DEFAULT_PROFILE, config=None):
+    """
+    :param name: Profile name
+    :param config: Optional JSON file with a "profiles" object
+    :return: dict of the profile settings
+    """
+    profiles = dict(PROFILES)
+    if config is not None:
+        with open(config) as f:
+            profiles.update(json.load(f).get("profiles", dict()))
+    if name not in profiles:
+        raise KeyError("Unknown resource profile {0}, available: {1}".format(name, sorted(profiles)))
+    return dict(profiles[name])
+
+
+def resolve(profile, input_bytes=0, input_count=0, cores=None, memory_gb=None, partition_mb=None, tmp_dir=None):
+    """
+    Resolves a profile against the host and the input into the Spark and Hail settings. Arguments that are not
+    None override the profile.
+    :return: dict with the Spark settings (spark), Hail's min_block_size, tmp_dir, the expected number of input
+    partitions and the values they were derived from
+    """
+    host_cores = detect_cores()
+    host_memory = detect_memory_gb()
+    cores = cores or profile.get("cores") or host_cores
+    memory_gb = memory_gb or profile.get("memory_gb")
+    if memory_gb is None:
+        fraction = profile.get("memory_fraction", DEFAULT_MEMORY_FRACTION)
+        memory_gb = max(1, int((host_memory or 8) * fraction - RESERVED_MEMORY_GB))
+    partition_mb = partition_mb or profile.get("partition_mb") or DEFAULT_PARTITION_MB
+    tmp_dir = tmp_dir or profile.get("tmp_dir") or tempfile.gettempdir()
+    partition_bytes = int(partition_mb * 1024 * 1024)
+    # Every input is at least one partition, large inputs are split into partition_mb blocks
+    expected_partitions = max(input_count, math.ceil(input_bytes / partition_bytes)) if input_bytes else input_count
+
+    spark = {
+        "spark.master": "local[{0}]".format(cores),
+        "spark.driver.memory": "{0}g".format(int(memory_gb)),
+        "spark.sql.files.maxPartitionBytes": str(partition_bytes),
+        "spark.sql.files.openCostInBytes": str(OPEN_COST_BYTES),
+        "spark.default.parallelism": str(max(1, cores * 2)),
+        "spark.local.dir": str(tmp_dir),
+    }
+    spark.update(profile.get("spark", dict()))
+    return {"spark": spark, "min_block_size": max(1, int(partition_mb)), "tmp_dir": str(tmp_dir),
+            "expected_partitions": expected_partitions, "cores": cores, "memory_gb": memory_gb,
+            "host_cores": host_cores, "host_memory_gb": host_memory, "input_bytes": input_bytes,
+            "input_count": input_count}
+
+
+def describe(settings):
+    """
+    :return: Human readable summary of resolved settings, printed by --dry-run
+    """
+    lines = ["Host: {0} core(s), {1} GB RAM".format(
+                 settings["host_cores"], "unknown" if settings["host_memory_gb"] is None
+                 else round(settings["host_memory_gb"], 1)),
+             "Input: {0} item(s), {1:.2f} GB".format(settings["input_count"], settings["input_bytes"] / 1024 ** 3),
+             "Expected input partitions: {0}".format(settings["expected_partitions"]),
+             "Hail min_block_size: {0} MB, tmp_dir: {1}".format(settings["min_block_size"], settings["tmp_dir"])]
+    lines += ["{0}={1}".format(key, value) for key, value in sorted(settings["spark"].items())]
+    return "\n".join(lines)
+
+
+def add_arguments(parser):
+    """
+    Adds the resource profile options to an argparse (sub)parser.
+    """
+    parser.add_argument("--profile", help="Resource profile: {0} or one of --resources (default {1})."
+                        .format(", ".join(PROFILES), DEFAULT_PROFILE), default=DEFAULT_PROFILE)
+    parser.add_argument("--resources", help="JSON file of resource profiles, {\"profiles\": {name: {...}}}.",
+                        type=str)
+    parser.add_argument("--cores", help="Local mode threads, overrides the profile.", type=int)
+    parser.add_argument("--memory", help="Driver memory in GB, overrides the profile.", type=float)
+    parser.add_argument("--partition-mb", help="Target input partition size in MB, overrides the profile.",
+                        type=float)
+    parser.add_argument("--tmp-dir", help="Spark and Hail temporary folder, overrides the profile.", type=str)
+    parser.add_argument("--dry-run", help="Print the resolved resource settings and quit before starting Spark.",
+                        action="store_true")
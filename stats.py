@@ -1,109 +1,1018 @@
 import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
 import sys
+import tempfile
+from multiprocessing import shared_memory
 from pathlib import Path
-import uuid
 import datetime
 
-import matplotlib.pyplot as plt
 
 import numpy as np
 import pandas as pd
 import scipy.stats as sp
+from scipy import special
 
 # rv_genes = ["BRCA1", "BRCA2", "CDH1", "PALB2", "TP53"]
 rv_genes = ["BRCA1", "BRCA2", "CHEK2", "PALB2", "ATM"]
 # neg_control_genes = ["BLM", "CEBPA", "FANCA", "FANCB", "GATA2"]
 neg_control_genes = ["APC", "BMPR1A", "MSH2", "MSH6", "PTEN"]
-fraction_results = pd.DataFrame()
-fraction_results_2 = pd.DataFrame()
-
-def permutation_analysis(gene_list, df_case, df_control, iterations=50000):
-    all_genes = df_case.gene
-    case_genes_length = len(gene_list)  # e.g. 5 genes
-
-    df_case = df_case.dropna(
-        subset=["gene"])  # drop gene '' and trailing other empty genes (all rows must have gene names)
-    df_control = df_control.dropna(
-        subset=["gene"])  # drop gene '' and trailing other empty genes (all rows must have gene names)
-    # df_case_std = df_case.std()
-    # df_control_std = df_control.std()
-    df_fraction = df_case.iloc[:, 1:] / 1389 / df_control.iloc[:, 1:] / 826
-    df_case_mean = df_case.mean()
-    df_control_mean = df_control.mean()
+# Default cohort sizes (samples) the cohort normalized ratio is scaled by
+CASE_SAMPLES = 1389
+CONTROL_SAMPLES = 826
+# Permutations per shard. Shards, not workers, own a random stream, so results only depend on the seed and
+# the iteration count. Changing this changes the permutations drawn for a given seed.
+SHARD_SIZE = 50000
+# Permutations between the stopping checks of the sequential mode
+SEQUENTIAL_BATCH = 1000
+# Largest (k + 1) x case sum x control sum grid of the exact null, about 400 MB
+EXACT_MAX_CELLS = 50000000
+# Exact null grid updates that take about as long as permuting one gene of one column
+EXACT_OPS_PER_GENE = 20
+# Smallest k (and number of genes left out of the set) for which auto falls back to the normal approximation of
+# vals2 when the exact grid is too large. Below it the set sum is too skewed and the column is permuted instead.
+NORMAL_MIN_K = 100
+_worker_state = dict()
+
+def sample_gene_sets(rng, n_genes, k, iterations):
+    """
+    Draws all permutation gene sets at once as an (iterations x k) matrix of row positions, sampled without
+    replacement within each row. Uses a vectorized Floyd sampler, memory is O(iterations * k) regardless of the
+    number of genes in the table. Rows are sorted so that sums run in the same order as the reference loop.
+    :param rng: Seeded numpy.random.Generator
+    :param n_genes: Number of rows (genes) to sample from
+    :param k: Gene set size
+    :param iterations: Number of gene sets to draw
+    :return: numpy array of shape (iterations, k)
+    """
+    if k > n_genes:
+        raise ValueError("Cannot sample {0} genes from a table of {1} genes.".format(k, n_genes))
+    idx = np.empty((iterations, k), dtype=np.intp)
+    for col, j in enumerate(range(n_genes - k, n_genes)):
+        t = rng.integers(0, j + 1, size=iterations)
+        if col > 0:
+            # Floyd: a value that was already drawn in this row is replaced by j, which can't have been drawn yet
+            t = np.where((idx[:, :col] == t[:, None]).any(axis=1), j, t)
+        idx[:, col] = t
+    idx.sort(axis=1)
+    return idx
+
+
+def sum_statistics(case_sums, control_sums, k, case_mean, control_mean, samples=(CASE_SAMPLES, CONTROL_SAMPLES)):
+    """
+    Both permutation statistics as a function of the case and control sums of a gene set of size k, NaN where
+    either sum is 0. Shared by the exact null and the observed values it is compared with.
+    :param samples: tuple of (case samples, control samples), the cohort sizes vals2 is normalized by
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vals = np.divide(case_sums - k * case_mean, control_sums - k * control_mean)
+        vals2 = np.divide(np.divide(case_sums, samples[0]), np.divide(control_sums, samples[1]))
+    empty = (np.asarray(case_sums) == 0) | (np.asarray(control_sums) == 0)
+    return np.where(empty, np.nan, vals), np.where(empty, np.nan, vals2)
+
+
+def permutation_statistics(counts, case_mean, control_mean, idx, samples=(CASE_SAMPLES, CONTROL_SAMPLES)):
+    """
+    Computes both permutation ratio statistics for every sampled gene set and every frequency column as whole
+    array operations. Gene sets where either the case or the control sum is 0 get NaN for both statistics.
+    :param counts: (genes x columns x {case, control}) array of variant counts, see AlignedTables.column_counts
+    :param case_mean: Per column mean of the case counts
+    :param control_mean: Per column mean of the control counts
+    :param idx: (iterations x k) matrix of sampled gene positions, see sample_gene_sets
+    :param samples: tuple of (case samples, control samples)
+    :return: tuple of (vals, vals2) arrays of shape (iterations, columns)
+    """
+    # Summed one gene of the sets at a time, counts[idx] would hold (iterations x k x columns x 2) values at once.
+    # The counts are integers, so the sums are exact in any order.
+    sums = np.zeros((idx.shape[0],) + counts.shape[1:])
+    for j in range(idx.shape[1]):
+        sums += counts[idx[:, j]]
+    # Difference of means
+    # Case k gene mean / control k gene mean (both mean normalized)
+    return sum_statistics(sums[..., 0], sums[..., 1], idx.shape[1], case_mean, control_mean, samples)
+
+
+def _merge_moments(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    # Chan et al. pairwise update of count, mean and sum of squared deviations
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(n > 0, mean_a + delta * np.divide(n_b, n), 0.0)
+        m2 = np.where(n > 0, m2_a + m2_b + delta ** 2 * np.divide(n_a * n_b, n), 0.0)
+    return n, mean, m2
+
+
+def _batch_moments(x):
+    finite = np.isfinite(x)
+    n = finite.sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(n > 0, np.divide(np.where(finite, x, 0.0).sum(axis=0), n), 0.0)
+    m2 = np.where(finite, (np.where(finite, x, 0.0) - mean) ** 2, 0.0).sum(axis=0)
+    return n, mean, m2
+
+
+class NullAccumulator():
+    """
+    Constant memory summary of the permutation null distribution of every frequency column. Tracks the number
+    of permutations at or above the observed statistic (empirical p-values), the streaming mean and variance of
+    log2(vals) (the normal fit) and of vals2, and fixed-bin histograms for plotting. The full vectors are only
+    kept with keep_values.
+    """
+    def __init__(self, columns, observed=None, observed2=None, bins=200, log_range=(-10, 10), ratio_range=(0, 10),
+                 keep_values=False):
+        self.columns = list(columns)
+        n_cols = len(self.columns)
+        self.observed = np.full(n_cols, np.nan) if observed is None else np.asarray(observed, dtype=float)
+        self.observed2 = np.full(n_cols, np.nan) if observed2 is None else np.asarray(observed2, dtype=float)
+        self.log_edges = np.linspace(log_range[0], log_range[1], bins + 1)
+        self.ratio_edges = np.linspace(ratio_range[0], ratio_range[1], bins + 1)
+        self.keep_values = keep_values
+        self.iterations = np.zeros(n_cols, dtype=np.int64)  # Permutations drawn per column
+        self.n = np.zeros(n_cols, dtype=np.int64)  # Permutations with a defined (non NaN) statistic
+        self.exceed = np.zeros(n_cols, dtype=np.int64)
+        self.exceed2 = np.zeros(n_cols, dtype=np.int64)
+        self.log_moments = (np.zeros(n_cols, dtype=np.int64), np.zeros(n_cols), np.zeros(n_cols))
+        self.ratio_moments = (np.zeros(n_cols, dtype=np.int64), np.zeros(n_cols), np.zeros(n_cols))
+        self.log_min = np.full(n_cols, np.inf)
+        self.log_max = np.full(n_cols, -np.inf)
+        self.log_hist = np.zeros((n_cols, bins))
+        self.ratio_hist = np.zeros((n_cols, bins))
+        self.values = []
+        self.values2 = []
+        self.stopped = np.full(n_cols, "", dtype=object)  # Reason a column stopped early or its analytic null
+        self.analytic = np.zeros(n_cols, dtype=bool)  # Columns with an exact or approximated null distribution
+        self.analytic_p = np.full(n_cols, np.nan)
+        self.analytic_p2 = np.full(n_cols, np.nan)
+
+    def empty_copy(self):
+        return NullAccumulator(self.columns, self.observed, self.observed2, len(self.log_edges) - 1,
+                               (self.log_edges[0], self.log_edges[-1]),
+                               (self.ratio_edges[0], self.ratio_edges[-1]), self.keep_values)
+
+    def update(self, vals, vals2, columns=None):
+        """
+        Adds a batch of permutation statistics.
+        :param vals: (iterations x columns) array of mean normalized ratios
+        :param vals2: (iterations x columns) array of cohort size normalized ratios
+        :param columns: Positions of the columns in vals when only a subset of columns was permuted
+        """
+        if columns is not None:
+            full = np.full((vals.shape[0], len(self.columns)), np.nan)
+            full2 = full.copy()
+            full[:, columns] = vals
+            full2[:, columns] = vals2
+            vals, vals2 = full, full2
+            self.iterations[columns] += vals.shape[0]
+        else:
+            self.iterations += vals.shape[0]
+        self.n += (~np.isnan(vals)).sum(axis=0)
+        self.exceed += (vals >= self.observed).sum(axis=0)
+        self.exceed2 += (vals2 >= self.observed2).sum(axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_vals = np.log2(vals)
+        self.log_moments = _merge_moments(*self.log_moments, *_batch_moments(log_vals))
+        self.ratio_moments = _merge_moments(*self.ratio_moments, *_batch_moments(vals2))
+        finite = np.isfinite(log_vals)
+        self.log_min = np.minimum(self.log_min, np.where(finite, log_vals, np.inf).min(axis=0, initial=np.inf))
+        self.log_max = np.maximum(self.log_max, np.where(finite, log_vals, -np.inf).max(axis=0, initial=-np.inf))
+        for c in range(len(self.columns)):
+            self.log_hist[c] += np.histogram(log_vals[finite[:, c], c], bins=self.log_edges)[0]
+            self.ratio_hist[c] += np.histogram(vals2[~np.isnan(vals2[:, c]), c], bins=self.ratio_edges)[0]
+        if self.keep_values:
+            self.values.append(vals)
+            self.values2.append(vals2)
+
+    def add_distribution(self, column, vals, vals2, probabilities, method="exact"):
+        """
+        Sets a column from its analytic null distribution instead of permutations, see exact_sum_distribution.
+        :param column: Position of the column
+        :param vals: Mean normalized ratio of every support point, None if only vals2 is known
+        :param vals2: Cohort size normalized ratio of every support point
+        :param probabilities: Probability of every support point, or the tail probability of vals2 for the normal
+        approximation
+        :param method: Name of the null reported in the summary
+        """
+        self.analytic[column] = True
+        self.stopped[column] = method
+        if vals is None:
+            self.analytic_p2[column] = probabilities if not np.isnan(self.observed2[column]) else np.nan
+            return
+        valid = ~np.isnan(vals2)
+        weights = probabilities[valid] / probabilities[valid].sum()
+        vals, vals2 = vals[valid], vals2[valid]
+        self.analytic_p[column] = weights[vals >= self.observed[column]].sum() if not np.isnan(
+            self.observed[column]) else np.nan
+        self.analytic_p2[column] = weights[vals2 >= self.observed2[column]].sum() if not np.isnan(
+            self.observed2[column]) else np.nan
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_vals = np.log2(vals)
+        finite = np.isfinite(log_vals)
+        log_weights = weights[finite] / weights[finite].sum() if finite.any() else weights[finite]
+        log_vals = log_vals[finite]
+        mean = np.sum(log_weights * log_vals)
+        # Moments are stored with a unit count, so that fit() returns the weighted mean and standard deviation
+        self.log_moments[0][column], self.log_moments[1][column] = 1, mean
+        self.log_moments[2][column] = np.sum(log_weights * (log_vals - mean) ** 2)
+        self.ratio_moments[0][column], self.ratio_moments[1][column] = 1, np.sum(weights * vals2)
+        self.ratio_moments[2][column] = np.sum(weights * (vals2 - np.sum(weights * vals2)) ** 2)
+        if finite.any():
+            self.log_min[column], self.log_max[column] = log_vals.min(), log_vals.max()
+        self.log_hist[column] = np.histogram(log_vals, bins=self.log_edges, weights=log_weights)[0]
+        self.ratio_hist[column] = np.histogram(vals2, bins=self.ratio_edges, weights=weights)[0]
+
+    def merge(self, other):
+        """
+        Merges the accumulator of a following shard into this one.
+        """
+        self.iterations += other.iterations
+        self.n += other.n
+        self.exceed += other.exceed
+        self.exceed2 += other.exceed2
+        self.log_moments = _merge_moments(*self.log_moments, *other.log_moments)
+        self.ratio_moments = _merge_moments(*self.ratio_moments, *other.ratio_moments)
+        self.log_min = np.minimum(self.log_min, other.log_min)
+        self.log_max = np.maximum(self.log_max, other.log_max)
+        self.log_hist += other.log_hist
+        self.ratio_hist += other.ratio_hist
+        self.values.extend(other.values)
+        self.values2.extend(other.values2)
+
+    def p_values(self):
+        """
+        :return: tuple of empirical p-values (vals, vals2), (1 + #perm >= observed) / (1 + #perm), analytic
+        columns their tail probability. NaN where the observed statistic is NaN (a zero case or control sum) or where no permutation
+        gave a defined statistic.
+        """
+        p = (self.exceed + 1) / (self.n + 1)
+        p2 = (self.exceed2 + 1) / (self.n + 1)
+        p = np.where(np.isnan(self.observed) | (self.n == 0), np.nan, p)
+        p2 = np.where(np.isnan(self.observed2) | (self.n == 0), np.nan, p2)
+        return np.where(self.analytic, self.analytic_p, p), np.where(self.analytic, self.analytic_p2, p2)
+
+    def decide(self, alpha=0.05, confidence=0.99):
+        """
+        Sequential Monte Carlo stopping rules, marks the columns whose p-value is settled with respect to alpha.
+        A column stops when the Clopper-Pearson interval of its p-value lies entirely above or below alpha,
+        p_values stays (1 + #perm >= observed) / (1 + #perm) of the permutations drawn so far. Columns with a NaN
+        observed statistic, or without a defined statistic in any of their permutations, have no p-value and stop as undefined.
+        :return: Boolean array of the columns that are still undecided
+        """
+        active = self.stopped == ""
+        undefined = active & (np.isnan(self.observed) | ((self.iterations > 0) & (self.n == 0)))
+        self.stopped[undefined] = "undefined"
+        active &= ~undefined
+        x, n = self.exceed, self.n
+        lower = np.where(x > 0, sp.beta.ppf((1 - confidence) / 2, x, n - x + 1), 0.0)
+        upper = np.where(x < n, sp.beta.ppf(1 - (1 - confidence) / 2, x + 1, n - x), 1.0)
+        self.stopped[active & (n > 0) & (upper < alpha)] = "significant"
+        self.stopped[active & (n > 0) & (lower > alpha)] = "not significant"
+        return self.stopped == ""
+
+    def fit(self):
+        """
+        :return: tuple of (mu, std) of the normal distribution fitted to log2(vals), as sp.norm.fit would return
+        """
+        n, mean, m2 = self.log_moments
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(n > 0, mean, np.nan), np.where(n > 0, np.sqrt(np.divide(m2, n)), np.nan)
+
+    def ratio_mean(self):
+        n, mean, m2 = self.ratio_moments
+        return np.where(n > 0, mean, np.nan)
+
+    def summary(self):
+        p, p2 = self.p_values()
+        mu, std = self.fit()
+        return pd.DataFrame({"q": self.observed, "p": p, "n_perm": self.iterations, "q2": self.observed2, "p2": p2,
+                             "n": self.n, "mu_log": mu, "std_log": std, "mean2": self.ratio_mean(),
+                             "stopped": self.stopped}, index=self.columns)
+
+    def value_frames(self):
+        """
+        :return: tuple of (vals, vals2) DataFrames with one column per frequency column, only with keep_values
+        """
+        if not self.keep_values:
+            raise ValueError("Permutation values were not kept, rerun with keep_values.")
+        empty = [np.empty((0, len(self.columns)))]
+        return (pd.DataFrame(np.concatenate(self.values or empty), columns=self.columns),
+                pd.DataFrame(np.concatenate(self.values2 or empty), columns=self.columns))
+
+
+def shard_seeds(seed, iterations, shard_size=SHARD_SIZE):
+    """
+    Splits the iteration budget into fixed size shards, each with an independent SeedSequence.spawn child.
+    :param seed: Integer seed or None for fresh entropy
+    :param iterations: Total permutation iterations
+    :param shard_size: Permutations per shard
+    :return: list of (SeedSequence, shard iterations) in shard order
+    """
+    n_shards = -(-iterations // shard_size)
+    children = np.random.SeedSequence(seed).spawn(n_shards)
+    return [(child, min(shard_size, iterations - s * shard_size)) for s, child in enumerate(children)]
+
+
+def _share_array(arr):
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm
+
+
+def _attach_shared(specs, case_mean, control_mean, k, accumulator, columns, samples):
+    """
+    Pool initializer, maps the shared count array read-only into the worker process.
+    :param specs: dict of name -> (shared memory name, shape, dtype)
+    """
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        arr.flags.writeable = False
+        _worker_state[name] = (shm, arr)
+    _worker_state["params"] = (None, (case_mean, control_mean, k, accumulator, columns, samples))
+
+
+def _evaluate_shard(shard, counts, case_mean, control_mean, k, accumulator, columns, samples):
+    """
+    Draws and evaluates one shard of permutations.
+    :return: NullAccumulator of the shard
+    """
+    seed_seq, size = shard
+    idx = sample_gene_sets(np.random.default_rng(seed_seq), counts.shape[0], k, size)
+    shard_accumulator = accumulator.empty_copy()
+    shard_accumulator.update(*permutation_statistics(counts, case_mean, control_mean, idx, samples), columns)
+    return shard_accumulator
+
+
+def _run_shard(shard):
+    # Pool task, evaluates a shard with the arrays attached by _attach_shared
+    return _evaluate_shard(shard, _worker_state["counts"][1], *_worker_state["params"][1])
+
+
+def run_permutations(counts, case_mean, control_mean, k, iterations, accumulator, seed=None, workers=1,
+                     columns=None, samples=(CASE_SAMPLES, CONTROL_SAMPLES)):
+    """
+    Runs the vectorized permutation engine shard by shard, optionally over a process pool. The count array is
+    passed to the workers through shared memory and shard accumulators are merged in shard order as they arrive,
+    so the result is bit-identical for a given seed regardless of the number of workers.
+    :param counts: (genes x columns x {case, control}) array of variant counts
+    :param case_mean: Per column mean of the case counts
+    :param control_mean: Per column mean of the control counts
+    :param k: Gene set size
+    :param iterations: Total permutation iterations
+    :param accumulator: Empty NullAccumulator that receives the permutation statistics
+    :param seed: Integer seed, None draws fresh entropy
+    :param workers: Number of worker processes, 1 runs in the current process
+    :param columns: Positions of the columns to permute, defaults to all columns
+    :param samples: tuple of (case samples, control samples)
+    :return: The filled accumulator
+    """
+    if columns is not None:
+        counts = counts[:, columns]
+        case_mean, control_mean = case_mean[columns], control_mean[columns]
+    arrays = {"counts": np.ascontiguousarray(counts)}
+    shards = shard_seeds(seed, iterations)
+    if workers is None or workers <= 1 or len(shards) == 1:
+        # In process runs keep no module state, so concurrent calls (e.g. from threads) do not interfere
+        for shard in shards:
+            accumulator.merge(_evaluate_shard(shard, arrays["counts"], case_mean, control_mean, k, accumulator,
+                                              columns, samples))
+        return accumulator
+
+    shms = {name: _share_array(arr) for name, arr in arrays.items()}
+    try:
+        specs = {name: (shms[name].name, arr.shape, arr.dtype) for name, arr in arrays.items()}
+        with multiprocessing.Pool(min(workers, len(shards)), initializer=_attach_shared,
+                                  initargs=(specs, case_mean, control_mean, k, accumulator, columns,
+                                            samples)) as pool:
+            for shard_accumulator in pool.imap(_run_shard, shards):
+                accumulator.merge(shard_accumulator)
+    finally:
+        for shm in shms.values():
+            shm.close()
+            shm.unlink()
+    return accumulator
+
+
+def run_sequential(counts, case_mean, control_mean, k, iterations, accumulator, seed=None, alpha=0.05,
+                   confidence=0.99, batch_size=SEQUENTIAL_BATCH, samples=(CASE_SAMPLES, CONTROL_SAMPLES)):
+    """
+    Sequential (early stopping) variant of run_permutations. Permutations are drawn in small batches and after
+    each batch the columns whose p-value is settled are dropped, see NullAccumulator.decide. Later batches only
+    gather the still undecided columns, up to iterations permutations per column. Runs in the current process.
+    :param alpha: Significance level the p-values are compared against
+    :param confidence: Confidence level of the p-value interval
+    :param batch_size: Permutations between stopping checks
+    :return: The filled accumulator, accumulator.iterations holds the permutations used per column
+    """
+    # Columns with a NaN observed statistic are settled before any permutation
+    active = accumulator.decide(alpha, confidence)
+    for seed_seq, size in shard_seeds(seed, iterations, batch_size):
+        if not active.any():
+            break
+        columns = np.flatnonzero(active)
+        idx = sample_gene_sets(np.random.default_rng(seed_seq), counts.shape[0], k, size)
+        accumulator.update(*permutation_statistics(counts[:, columns], case_mean[columns], control_mean[columns],
+                                                   idx, samples), columns)
+        active = accumulator.decide(alpha, confidence)
+    return accumulator
+
+
+def exact_null_cost(case_col, control_col, k):
+    """
+    Size of the exact_sum_distribution grid and the number of cell updates needed to fill it.
+    :return: tuple of (cells, operations), None if the counts are not non-negative integers
+    """
+    counts = np.stack([case_col, control_col], axis=1)
+    if not np.all(np.isfinite(counts)) or np.any(counts < 0) or np.any(counts != np.round(counts)) or \
+            k > len(case_col):
+        return None
+    max_case = int(np.sort(case_col)[::-1][:k].sum())
+    max_control = int(np.sort(control_col)[::-1][:k].sum())
+    cells = (k + 1) * (max_case + 1) * (max_control + 1)
+    multiplicity = np.unique(counts, axis=0, return_counts=True)[1]
+    return cells, int((np.minimum(multiplicity, k) + 1).sum()) * cells
+
+
+def exact_sum_distribution(case_col, control_col, k):
+    """
+    Exact null distribution of the case and control count sums of a uniformly drawn set of k genes (without
+    replacement). Dynamic programming over the distinct (case, control) count pairs: a pair seen m times
+    contributes t genes in comb(m, t) ways, and the (set size, case sum, control sum) grid of subset counts is
+    convolved with each pair in turn.
+    :param case_col: Case counts of one frequency column, one value per gene
+    :param control_col: Control counts of the same genes
+    :param k: Gene set size
+    :return: tuple of (case_sums, control_sums, probabilities) over the support of the distribution
+    """
+    pairs, multiplicity = np.unique(np.stack([case_col, control_col], axis=1).astype(np.int64), axis=0,
+                                    return_counts=True)
+    max_case = int(np.sort(case_col)[::-1][:k].sum())
+    max_control = int(np.sort(control_col)[::-1][:k].sum())
+    grid = np.zeros((k + 1, max_case + 1, max_control + 1))
+    grid[0, 0, 0] = 1.0
+    for (c, d), m in zip(pairs, multiplicity):
+        updated = grid.copy()
+        for t in range(1, min(m, k) + 1):
+            updated[t:, t * c:, t * d:] += special.comb(m, t) * grid[:k + 1 - t, :max_case + 1 - t * c,
+                                                                    :max_control + 1 - t * d]
+        grid = updated
+    case_sums, control_sums = np.nonzero(grid[k])
+    ways = grid[k, case_sums, control_sums]
+    return case_sums, control_sums, ways / ways.sum()
+
+
+def normal_tail_vals2(case_col, control_col, k, observed_case_sum, observed_control_sum):
+    """
+    Normal approximation of P(vals2 >= observed) for large k. vals2 >= observed is equivalent to the set sum of
+    w = case * observed_control_sum - control * observed_case_sum being >= 0, a sum of k draws without replacement
+    with mean k * mean(w) and variance k * var(w) * (n - k) / (n - 1). vals has no such approximation, its
+    denominator is centered at 0.
+    """
+    w = np.asarray(case_col, dtype=float) * observed_control_sum - np.asarray(control_col,
+                                                                               dtype=float) * observed_case_sum
+    n = len(w)
+    std = np.sqrt(k * w.var() * (n - k) / max(n - 1, 1))
+    if std == 0:
+        return float(k * w.mean() >= 0)
+    return sp.norm.sf(-0.5, loc=k * w.mean(), scale=std)  # Integer sums, continuity corrected
+
+
+def choose_null(case_col, control_col, k, iterations, null="auto"):
+    """
+    Picks the null distribution engine of a frequency column.
+    :param null: auto uses the exact null when it is cheaper than drawing the permutations and the normal
+    approximation when the exact grid exceeds EXACT_MAX_CELLS but k and the genes left out both reach NORMAL_MIN_K,
+    exact always uses an analytic null (the normal approximation when the exact grid exceeds EXACT_MAX_CELLS) and
+    monte-carlo always permutes. The normal approximation only covers vals2, vals gets no p-value.
+    :return: "exact", "normal" or "monte-carlo"
+    """
+    if null == "monte-carlo":
+        return "monte-carlo"
+    cost = exact_null_cost(case_col, control_col, k)
+    if null == "exact":
+        return "exact" if cost is not None and cost[0] <= EXACT_MAX_CELLS else "normal"
+    if cost is not None and cost[0] <= EXACT_MAX_CELLS and cost[1] < iterations * k * EXACT_OPS_PER_GENE:
+        return "exact"
+    if cost is not None and cost[0] > EXACT_MAX_CELLS and min(k, len(case_col) - k) >= NORMAL_MIN_K:
+        return "normal"
+    return "monte-carlo"
+
+
+def run_analytic(counts, case_mean, control_mean, k, accumulator, observed_sums, methods,
+                 samples=(CASE_SAMPLES, CONTROL_SAMPLES)):
+    """
+    Fills the accumulator columns chosen for an analytic null, see choose_null.
+    :param counts: (genes x columns x {case, control}) array of variant counts
+    :param observed_sums: tuple of (case sums, control sums) arrays of the tested gene set
+    :param methods: Engine of every column
+    :param samples: tuple of (case samples, control samples)
+    """
+    for c, method in enumerate(methods):
+        case_col, control_col = counts[:, c, 0], counts[:, c, 1]
+        if method == "exact":
+            case_sums, control_sums, probabilities = exact_sum_distribution(case_col, control_col, k)
+            vals, vals2 = sum_statistics(case_sums, control_sums, k, case_mean[c], control_mean[c], samples)
+            accumulator.add_distribution(c, vals, vals2, probabilities)
+        elif method == "normal":
+            # A zero observed sum has no vals2 to compare with
+            p2 = normal_tail_vals2(case_col, control_col, k, observed_sums[0][c], observed_sums[1][c]) \
+                if observed_sums[0][c] != 0 and observed_sums[1][c] != 0 else np.nan
+            accumulator.add_distribution(c, None, None, p2, "normal")
+    return accumulator
+
+
+def _permutation_loop(aligned, idx, samples=(CASE_SAMPLES, CONTROL_SAMPLES)):
+    """
+    Reference implementation of permutation_statistics, one pandas sample per iteration. Kept for validating the
+    vectorized engine, both give identical results for the same sampled rows.
+    """
+    df_case, df_control = aligned.frame(0), aligned.frame(1)
+    iterations = idx.shape[0]
+    case_genes_length = idx.shape[1]
+    vals_all = np.empty((iterations, len(df_case.columns) - 1))
+    vals2_all = np.empty((iterations, len(df_case.columns) - 1))
     for i in range(1,
                    len(df_case.columns)):  # Go through each frequency column, with 0 being the gene.col and simulate j times.
         j = 0
-        column_name = df_case.columns[i]
         vals = []
         vals2 = []
         while j < iterations:
-            # indices = np.random.choice(df_fraction.shape[0], case_genes_length, replace=False)
-            # sampled_rows = df_case.iloc[indices]
-            # total_variants_case = df_case.iloc[indices, i]
-            # total_variants_control = df_control.iloc[indices, i]  # get the same rows (variant counts for specific gene) from controls
-            sampled_rows = df_case.sample(case_genes_length, axis=0)
-            total_variants_case = sampled_rows.iloc[:case_genes_length, i].sort_index()
-            total_variants_control = df_control.iloc[sampled_rows.index - 1, i].sort_index()
+            total_variants_case = df_case.iloc[idx[j], i]
+            total_variants_control = df_control.iloc[idx[j], i]  # the same genes from controls
             if total_variants_case.sum() != 0 and total_variants_control.sum() != 0:
                 # Difference of means
                 # Case 5 gene mean / control 5 gene mean (both mean normalized)
-                vals.append(np.divide(np.sum(total_variants_case - df_case_mean[i - 1]),
-                                      np.sum(total_variants_control - df_control_mean[i - 1])))
+                vals.append(np.divide(total_variants_case.sum() - case_genes_length * aligned.case_mean[i - 1],
+                                      total_variants_control.sum() - case_genes_length * aligned.control_mean[i - 1]))
                 vals2.append(
-                   np.divide(np.divide(total_variants_case.sum(), 1389), np.divide(total_variants_control.sum(), 826)))
+                   np.divide(np.divide(total_variants_case.sum(), samples[0]),
+                             np.divide(total_variants_control.sum(), samples[1])))
             else:
-                vals.append(np.NaN)
-                vals2.append(np.NaN)
+                vals.append(np.nan)
+                vals2.append(np.nan)
             j += 1
-        # sc.monte_carlo_test()
-        fraction_results[column_name] = vals
-        fraction_results_2[column_name] = vals2
-    print(fraction_results)
-    # fraction_results["low.gnomad_5_100"] = np.log2(fraction_results["low.gnomad_5_100"].astype(dtype=float))
-    # plt.hist(fraction_results["low.gnomad_5_100"], density=True, log=True, histtype="stepfilled", bins=100)
-    # plt.hlines(data=fraction_results["low.gnomad_5_100_log"])
-    fig, axs = plt.subplots(len(fraction_results.columns), 2, sharex="none", tight_layout=True, figsize=(20, 24))
-
-    i = 0
-    for frequency in fraction_results.columns:
-        q = np.sum(df_case[df_case.gene.isin(rv_genes)][frequency] - df_case_mean[frequency]) / np.sum(
-            df_control[df_control.gene.isin(rv_genes)][frequency] - df_control_mean[frequency])
-        q_control_group = np.sum(
-            df_case[df_case.gene.isin(neg_control_genes)][frequency] - df_case_mean[frequency]) / np.sum(
-            df_control[df_control.gene.isin(neg_control_genes)][frequency] - df_control_mean[frequency])
-        print(frequency, q, q_control_group)
-        fraction_results[frequency + "_log"] = np.log2(fraction_results[frequency].dropna())
-        if fraction_results[frequency].any():
-            mu, std = sp.norm.fit(fraction_results[frequency + "_log"].dropna())
-            xmin, xmax = fraction_results[frequency + "_log"].dropna().min(), fraction_results[
-                frequency + "_log"].dropna().max()
-            x = np.linspace(xmin, xmax, 100)
-            p = sp.norm.pdf(x, mu, std)
-
-            # axs[i].plot(x, p, 'k', linewidth=2)
-            axs[i, 0].hist(fraction_results[frequency + "_log"], density=True,
-                           log=False, histtype="stepfilled", stacked=False, bins=200)
+        vals_all[:, i - 1] = vals
+        vals2_all[:, i - 1] = vals2
+    return vals_all, vals2_all
+
+
+def _file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_table_cache(df, cache_dir, meta):
+    """
+    Writes the parsed table into a temporary directory next to cache_dir and renames it into place.
+    """
+    tmp_dir = Path(tempfile.mkdtemp(prefix=cache_dir.name + ".", dir=cache_dir.parent))
+    try:
+        genes = df.gene.fillna("").astype(str).to_numpy()
+        np.save(tmp_dir.joinpath("genes.npy"), genes.astype("U{0}".format(max(1, max(map(len, genes), default=1)))))
+        np.save(tmp_dir.joinpath("gene_missing.npy"), df.gene.isna().to_numpy())
+        np.save(tmp_dir.joinpath("counts.npy"), np.ascontiguousarray(df.iloc[:, 1:].to_numpy(dtype=float)))
+        np.save(tmp_dir.joinpath("means.npy"), df.dropna(subset=["gene"]).iloc[:, 1:].mean().to_numpy(dtype=float))
+        with open(tmp_dir.joinpath("meta.json"), "w") as f:
+            json.dump(meta, f)
+        if cache_dir.exists():
+            shutil.rmtree(cache_dir)
+        os.replace(tmp_dir, cache_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def load_frequency_table(path, use_cache=True):
+    """
+    Reads a frequency table TSV exported by main.py (gene column followed by the count columns). Parsed tables are
+    cached next to the TSV in <name>.cache/ as memory-mapped .npy files (gene index, counts and the column means
+    of the rows with a gene name). The cache is valid while the TSV size and mtime are unchanged, otherwise the
+    TSV content hash decides whether it has to be rebuilt.
+    :param path: Path to the TSV file
+    :param use_cache: Read and write the cache, False always parses the TSV
+    :return: DataFrame with the column means of the gene rows in df.attrs["means"]
+    """
+    path = Path(path)
+    cache_dir = path.with_name(path.name + ".cache")
+    stat = path.stat()
+    meta = None
+    if use_cache and cache_dir.joinpath("meta.json").is_file():
+        with open(cache_dir.joinpath("meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("size") != stat.st_size or meta.get("mtime_ns") != stat.st_mtime_ns:
+            digest = _file_digest(path)
+            if meta.get("sha256") == digest:
+                meta.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+                with open(cache_dir.joinpath("meta.json"), "w") as f:
+                    json.dump(meta, f)
+            else:
+                meta = None
+    if meta is None:
+        df = pd.read_csv(path, sep="\t", header=0)
+        if use_cache:
+            meta = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": _file_digest(path),
+                    "columns": [str(column) for column in df.columns]}
+            try:
+                _write_table_cache(df, cache_dir, meta)
+                sys.stderr.write("Cached {0} in {1}\n".format(path, cache_dir))
+            except OSError as e:
+                sys.stderr.write("Could not write the table cache {0}: {1}\n".format(cache_dir, e))
+        df.attrs["means"] = df.dropna(subset=["gene"]).iloc[:, 1:].mean()
+        return df
+
+    counts = np.load(cache_dir.joinpath("counts.npy"), mmap_mode="r")
+    genes = pd.Series(np.load(cache_dir.joinpath("genes.npy"), mmap_mode="r"), dtype=object)
+    genes[np.load(cache_dir.joinpath("gene_missing.npy"))] = np.nan
+    df = pd.DataFrame(counts, columns=meta["columns"][1:], copy=False)
+    df.insert(0, meta["columns"][0], genes)
+    df.attrs["means"] = pd.Series(np.load(cache_dir.joinpath("means.npy")), index=meta["columns"][1:])
+    return df
+
+
+class AlignedTables():
+    """
+    Case and control frequency tables joined on the gene name into one contiguous
+    (gene x impact x AF bin x {case, control}) count array, built once by align_tables. Genes missing from one of
+    the tables have zero counts there.
+    """
+    def __init__(self, genes, impacts, bins, counts, case_mean=None, control_mean=None):
+        self.genes = np.asarray(genes, dtype=object)
+        self.impacts = list(impacts)
+        self.bins = list(bins)
+        self.counts = np.ascontiguousarray(counts, dtype=float)
+        self.frequencies = ["{0}.{1}".format(impact, af_bin) for impact in self.impacts for af_bin in self.bins]
+        self.gene_index = {gene: i for i, gene in enumerate(self.genes)}
+        column_counts = self.column_counts
+        self.case_mean = column_counts[..., 0].mean(axis=0) if case_mean is None else np.asarray(case_mean)
+        self.control_mean = column_counts[..., 1].mean(axis=0) if control_mean is None else np.asarray(control_mean)
+
+    @property
+    def column_counts(self):
+        """
+        (genes x frequency columns x {case, control}) view of the counts, the layout used by the engines
+        """
+        return self.counts.reshape(len(self.genes), len(self.frequencies), 2)
+
+    def frame(self, table):
+        """
+        :param table: 0 for cases, 1 for controls
+        :return: DataFrame of one table in the layout of the input TSV
+        """
+        df = pd.DataFrame(self.column_counts[..., table], columns=self.frequencies)
+        df.insert(0, "gene", self.genes)
+        return df
+
+    def gene_rows(self, genes):
+        return np.array([self.gene_index[gene] for gene in genes if gene in self.gene_index], dtype=np.intp)
+
+    def gene_set_sums(self, genes):
+        """
+        :return: tuple of (case sums, control sums, genes found) of one gene set
+        """
+        rows = self.gene_rows(genes)
+        sums = self.column_counts[rows].sum(axis=0)
+        return sums[:, 0], sums[:, 1], len(rows)
+
+
+def _summed_genes(df, frequencies, name):
+    # Rows without a gene name are dropped, duplicate genes are summed
+    missing = df.gene.isna().sum()
+    df = df.dropna(subset=["gene"])
+    duplicated = df.gene.duplicated().sum()
+    if duplicated > 0:
+        df = df.groupby("gene", sort=False, as_index=False)[frequencies].sum()
+    if missing > 0 or duplicated > 0:
+        sys.stderr.write("{0} table: dropped {1} row(s) without a gene name, summed {2} duplicate gene row(s)\n"
+                         .format(name, missing, duplicated))
+    return df, missing == 0 and duplicated == 0
+
+
+def align_tables(df_case, df_control):
+    """
+    Joins the case and control tables on the gene name, replacing the positional row matching of the exported
+    TSVs. Frequency columns are named <impact>.<AF bin> (e.g. low.gnomad_1_5) and matched by name. Genes found in
+    only one table are zero filled and reported. Column means cached by load_frequency_table are reused when the
+    table needed no filling.
+    :return: AlignedTables
+    """
+    frequencies = [str(column) for column in df_case.columns[1:]]
+    if set(frequencies) != set(str(column) for column in df_control.columns[1:]):
+        raise ValueError("Case and control tables have different frequency columns: {0}".format(
+            sorted(set(frequencies) ^ set(str(column) for column in df_control.columns[1:]))))
+    impacts, bins = [], []
+    for column in frequencies:
+        impact, separator, af_bin = column.partition(".")
+        if separator == "":
+            raise ValueError("Frequency column {0} is not named <impact>.<AF bin>".format(column))
+        if impact not in impacts:
+            impacts.append(impact)
+        if af_bin not in bins:
+            bins.append(af_bin)
+    if len(impacts) * len(bins) != len(frequencies):
+        raise ValueError("Frequency columns do not form a full impact x AF bin grid: {0}".format(frequencies))
+    ordered = ["{0}.{1}".format(impact, af_bin) for impact in impacts for af_bin in bins]
+
+    case, case_complete = _summed_genes(df_case, ordered, "Case")
+    control, control_complete = _summed_genes(df_control, ordered, "Control")
+    genes = list(case.gene) + [gene for gene in control.gene[~control.gene.isin(case.gene)]]
+    gene_index = {gene: i for i, gene in enumerate(genes)}
+    counts = np.zeros((len(genes), len(impacts), len(bins), 2))
+    counts[:len(case), ..., 0] = case[ordered].to_numpy(dtype=float).reshape(len(case), len(impacts), len(bins))
+    control_positions = np.array([gene_index[gene] for gene in control.gene], dtype=np.intp)
+    counts[control_positions, ..., 1] = control[ordered].to_numpy(dtype=float).reshape(len(control), len(impacts),
+                                                                                       len(bins))
+    case_only = case.gene[~case.gene.isin(control.gene)].tolist()
+    control_only = control.gene[~control.gene.isin(case.gene)].tolist()
+    sys.stderr.write("Aligned {0} genes, {1} only in cases and {2} only in controls (zero filled)\n"
+                     .format(len(genes), len(case_only), len(control_only)))
+    for name, only in (("cases", case_only), ("controls", control_only)):
+        if len(only) > 0:
+            sys.stderr.write("Genes only in {0}: {1}{2}\n".format(name, ", ".join(map(str, only[:10])),
+                                                                    " ..." if len(only) > 10 else ""))
+    if len(genes) > 0 and (len(genes) - len(case_only) - len(control_only)) < len(genes) / 2:
+        sys.stderr.write("WARNING: Less than half of the genes are shared by the case and control tables.\n")
+
+    case_mean = control_mean = None
+    if case_complete and len(control_only) == 0 and df_case.attrs.get("means") is not None:
+        case_mean = df_case.attrs["means"][ordered].to_numpy(dtype=float)
+    if control_complete and len(case_only) == 0 and df_control.attrs.get("means") is not None:
+        control_mean = df_control.attrs["means"][ordered].to_numpy(dtype=float)
+    return AlignedTables(genes, impacts, bins, counts, case_mean, control_mean)
+
+
+class PermutationTest():
+    """
+    Reentrant permutation test over one pair of aligned frequency tables. Holds the count array, the cohort sizes
+    and the column means, so a single instance answers any number of gene set queries (from one process, threads
+    or a long-lived service) without reloading the tables. Nothing is stored between runs.
+    """
+    def __init__(self, aligned, case_samples=CASE_SAMPLES, control_samples=CONTROL_SAMPLES):
+        """
+        :param aligned: AlignedTables, see align_tables
+        :param case_samples: Number of samples in the case cohort
+        :param control_samples: Number of samples in the control cohort
+        """
+        if case_samples <= 0 or control_samples <= 0:
+            raise ValueError("Cohort sizes must be positive, got {0} cases and {1} controls."
+                             .format(case_samples, control_samples))
+        self.aligned = aligned
+        self.counts = aligned.column_counts
+        self.case_mean = aligned.case_mean
+        self.control_mean = aligned.control_mean
+        self.samples = (case_samples, control_samples)
+        self.frequencies = aligned.frequencies
+
+    @classmethod
+    def from_tables(cls, df_case, df_control, case_samples=CASE_SAMPLES, control_samples=CONTROL_SAMPLES):
+        return cls(align_tables(df_case, df_control), case_samples, control_samples)
+
+    def observed(self, genes):
+        """
+        Observed statistics of one gene set. As for the permutations, columns where the case or the control sum
+        is 0 are NaN.
+        :return: tuple of (q, q2, case sums, control sums, genes found), arrays by frequency column
+        """
+        case_sums, control_sums, k = self.aligned.gene_set_sums(genes)
+        q, q2 = sum_statistics(case_sums, control_sums, k, self.case_mean, self.control_mean, self.samples)
+        return q, q2, case_sums, control_sums, k
+
+    def run(self, gene_set, iterations=50000, seed=None, engine="vectorized", workers=1, keep_values=False,
+            bins=200, sequential=False, alpha=0.05, confidence=0.99, null="auto"):
+        """
+        Tests one gene set. Genes missing from the tables are ignored, the set size is the number of genes found.
+        :param gene_set: Iterable of gene names
+        :param iterations: Permutations per column (the maximum with sequential)
+        :param seed: Integer seed, None draws fresh entropy
+        :param engine: vectorized, or loop for the slow pandas reference
+        :return: The filled NullAccumulator, see NullAccumulator.summary
+        """
+        q, q2, case_sums, control_sums, k = self.observed(set(gene_set))
+        if k == 0:
+            raise ValueError("None of the genes {0} are in the frequency tables.".format(sorted(set(gene_set))))
+        accumulator = NullAccumulator(self.frequencies, q, q2, bins=bins, keep_values=keep_values)
+        if engine == "loop":
+            idx = np.concatenate([sample_gene_sets(np.random.default_rng(seed_seq), self.counts.shape[0], k, size)
+                                  for seed_seq, size in shard_seeds(seed, iterations)])
+            accumulator.update(*_permutation_loop(self.aligned, idx, self.samples))
+            return accumulator
+        methods = [choose_null(self.counts[:, c, 0], self.counts[:, c, 1], k, iterations, null)
+                   for c in range(len(self.frequencies))]
+        run_analytic(self.counts, self.case_mean, self.control_mean, k, accumulator, (case_sums, control_sums),
+                     methods, self.samples)
+        monte_carlo = [c for c, method in enumerate(methods) if method == "monte-carlo"]
+        if sequential:
+            run_sequential(self.counts, self.case_mean, self.control_mean, k, iterations, accumulator, seed, alpha,
+                           confidence, samples=self.samples)
+        elif len(monte_carlo) > 0:
+            run_permutations(self.counts, self.case_mean, self.control_mean, k, iterations, accumulator, seed,
+                             workers, monte_carlo, self.samples)
+        return accumulator
+
+
+class AnalysisResult():
+    """
+    Outcome of permutation_analysis: the filled NullAccumulator (p-values, fitted moments and histogram bins of
+    every frequency column) and the observed values of the tested and the negative control gene set.
+    """
+    def __init__(self, accumulator, observed_control, genes, control_genes):
+        self.accumulator = accumulator
+        self.observed = accumulator.observed
+        self.observed_control = observed_control
+        self.genes = list(genes)
+        self.control_genes = list(control_genes)
+
+    def summary(self):
+        """
+        :return: NullAccumulator.summary with the observed value of the negative control set as q_control
+        """
+        table = self.accumulator.summary()
+        table.insert(1, "q_control", self.observed_control)
+        return table
+
+
+def permutation_analysis(gene_list, df_case, df_control, iterations=50000, seed=None, engine="vectorized", workers=1,
+                         keep_values=False, bins=200, sequential=False, alpha=0.05, confidence=0.99, null="auto",
+                         control_genes=None, case_samples=CASE_SAMPLES, control_samples=CONTROL_SAMPLES):
+    """
+    Permutation test of one gene set against the case and control frequency tables, together with the negative
+    control gene set (neg_control_genes by default). Nothing is printed or drawn, see plot_analysis. Use
+    PermutationTest directly to test several gene sets against the same tables.
+    :return: AnalysisResult
+    """
+    control_genes = neg_control_genes if control_genes is None else control_genes
+    test = PermutationTest.from_tables(df_case, df_control, case_samples, control_samples)
+    accumulator = test.run(gene_list, iterations, seed, engine, workers, keep_values, bins, sequential, alpha,
+                           confidence, null)
+    return AnalysisResult(accumulator, test.observed(set(control_genes))[0], gene_list, control_genes)
+
+
+def plot_analysis(result, path):
+    """
+    Renders the null distributions of an analysis from its histogram bins, one row per frequency column with the
+    log ratio and the cohort size normalized ratio. matplotlib is only imported here and uses the non-interactive
+    Agg backend, so computing an analysis never needs it.
+    :param result: AnalysisResult
+    :param path: Output image path, the format follows the suffix (e.g. .png, .pdf)
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    accumulator = result.accumulator
+    frequencies = accumulator.columns
+    q, q_control_group = result.observed, result.observed_control
+    fig, axs = plt.subplots(len(frequencies), 2, sharex="none", tight_layout=True, figsize=(20, 24), squeeze=False)
+
+    mu, std = accumulator.fit()
+    ratio_mean = accumulator.ratio_mean()
+    for i, frequency in enumerate(frequencies):
+        if accumulator.log_hist[i].any():
+            axs[i, 0].stairs(accumulator.log_hist[i] / accumulator.log_hist[i].sum() / np.diff(accumulator.log_edges),
+                             accumulator.log_edges, fill=True)
             axs[i, 0].set_title(
                 '{0}: fit values mu ({1}) std({2}) data_mean={3} case={4} control={5}'.format(
-                    fraction_results[frequency].name + "_log",
-                    np.round(mu, 2), np.round(std, 2),
-                    np.round(fraction_results[frequency + "_log"].mean(), 2),
-                    np.round(q, 2), np.round(q_control_group, 2)))
-            axs[i, 0].axvline(np.log2(q), color='orange')
-            axs[i, 0].axvline(np.log2(q_control_group), color="red")
-            axs[i, 1].hist(fraction_results_2[frequency], density=True,
-                           log=True, histtype="stepfilled", bins=200)
+                    frequency + "_log",
+                    np.round(mu[i], 2), np.round(std[i], 2),
+                    np.round(mu[i], 2),
+                    np.round(q[i], 2), np.round(q_control_group[i], 2)))
+            # Ratios at or below 0 have no log and are not marked
+            if q[i] > 0:
+                axs[i, 0].axvline(np.log2(q[i]), color='orange')
+            if q_control_group[i] > 0:
+                axs[i, 0].axvline(np.log2(q_control_group[i]), color="red")
+        if accumulator.ratio_hist[i].any():
+            axs[i, 1].stairs(
+                accumulator.ratio_hist[i] / accumulator.ratio_hist[i].sum() / np.diff(accumulator.ratio_edges),
+                accumulator.ratio_edges, fill=True)
+            axs[i, 1].set_yscale("log")
             axs[i, 1].set_title(
-                "{0} data_mean {1}".format(fraction_results_2[frequency].name,
-                                           np.round(fraction_results_2[frequency].mean(), 2)))
-            #axs[i, 1].axvline(np.log2(q), color='orange')
-            #axs[i, 1].axvline(np.log2(q_control_group), color="red")
+                "{0} data_mean {1}".format(frequency, np.round(ratio_mean[i], 2)))
+
+    fig.text(s=result.genes, x=0.2, y=0.05, color="orange", ha="left")
+    fig.text(s=result.control_genes, x=0.7, y=0.05, color="red", ha="left")
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def read_gene_sets(path):
+    """
+    Reads gene sets from a GMT file (set name, description, genes...) or from a two column TSV file
+    (set name, gene), one gene per line.
+    :param path: Path to a .gmt or .tsv file
+    :return: dict of set name -> list of genes
+    """
+    gene_sets = dict()
+    with open(path) as f:
+        for line in f:
+            s = line.rstrip("\n").split("\t")
+            if len(s) < 2 or line.startswith("#"):
+                continue
+            if Path(path).suffix.lower() == ".gmt":
+                gene_sets[s[0]] = [gene for gene in s[2:] if gene != ""]
+            else:
+                gene_sets.setdefault(s[0], []).append(s[1])
+    return gene_sets
+
 
-        i += 1
-    fig.text(s=rv_genes, x=0.2, y=0.05, color="orange", ha="left")
-    fig.text(s=neg_control_genes, x=0.7, y=0.05, color="red", ha="left")
+def benjamini_hochberg(p):
+    """
+    Benjamini-Hochberg FDR adjusted p-values, NaN p-values are ignored and stay NaN.
+    """
+    p = np.asarray(p, dtype=float)
+    adjusted = np.full(p.shape, np.nan)
+    tested = np.flatnonzero(~np.isnan(p))
+    order = tested[np.argsort(p[tested], kind="stable")]
+    ranked = p[order] * len(order) / np.arange(1, len(order) + 1)
+    adjusted[order] = np.minimum(np.minimum.accumulate(ranked[::-1])[::-1], 1)
+    return adjusted
 
-    plt.show()
+
+def _exceedances(sorted_null, observed):
+    # Number of null values at or above each observed value, null sorted ascending without NaN
+    return len(sorted_null) - np.searchsorted(sorted_null, observed, side="left")
+
+
+def screen_gene_sets(gene_sets, test, iterations=50000, seed=None, workers=1, null="auto"):
+    """
+    Tests many gene sets against one pair of frequency tables. The tables are aligned once and, as the null
+    distribution only depends on the gene set size k, one null per distinct k and column is shared by every set
+    of that size: the exact null where it is cheaper (see choose_null), otherwise one bank of permutations.
+    P-values are FDR adjusted (Benjamini-Hochberg) per frequency column.
+    :param gene_sets: dict of set name -> list of genes, see read_gene_sets
+    :param test: PermutationTest holding the tables and cohort sizes
+    :return: DataFrame with one row per gene set and frequency column
+    """
+    aligned, counts, samples = test.aligned, test.counts, test.samples
+    case_mean, control_mean = test.case_mean, test.control_mean
+    frequencies = test.frequencies
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    set_sizes = dict()
+    for name, genes in gene_sets.items():
+        found = len(aligned.gene_rows(set(genes)))
+        if found < len(set(genes)):
+            sys.stderr.write("Gene set {0}: {1} of {2} genes not found in the frequency tables.\n"
+                             .format(name, len(set(genes)) - found, len(set(genes))))
+        if found > 0:
+            set_sizes.setdefault(found, []).append(name)
+
+    results = []
+    for k in sorted(set_sizes):
+        methods = [choose_null(counts[:, c, 0], counts[:, c, 1], k, iterations, null)
+                   for c in range(len(frequencies))]
+        monte_carlo = [c for c, method in enumerate(methods) if method == "monte-carlo"]
+        sys.stderr.write("Testing {0} gene set(s) of size {1}, {2} of {3} columns permuted\n"
+                         .format(len(set_sizes[k]), k, len(monte_carlo), len(frequencies)))
+        vals = vals2 = None
+        if len(monte_carlo) > 0:
+            bank = run_permutations(counts, case_mean, control_mean, k, iterations,
+                                    NullAccumulator(frequencies, keep_values=True), [seed, k], workers, monte_carlo,
+                                    samples)
+            vals, vals2 = (np.concatenate(values) for values in (bank.values, bank.values2))
+        observed = []
+        for name in set_sizes[k]:
+            q, q2, case_sums, control_sums, _ = test.observed(set(gene_sets[name]))
+            observed.append((name, case_sums, control_sums, q, q2))
+        for c, frequency in enumerate(frequencies):
+            case_col, control_col = counts[:, c, 0], counts[:, c, 1]
+            # Permutations behind the p-values, none for the analytic nulls
+            n = 0
+            if methods[c] == "monte-carlo":
+                null_vals = np.sort(vals[~np.isnan(vals[:, c]), c])
+                null_vals2 = np.sort(vals2[~np.isnan(vals2[:, c]), c])
+                n = len(null_vals)
+            elif methods[c] == "exact":
+                case_sums, control_sums, probabilities = exact_sum_distribution(case_col, control_col, k)
+                support_vals, support_vals2 = sum_statistics(case_sums, control_sums, k, case_mean[c],
+                                                             control_mean[c], samples)
+                valid = ~np.isnan(support_vals2)
+                weights = probabilities[valid] / probabilities[valid].sum()
+                support_vals, support_vals2 = support_vals[valid], support_vals2[valid]
+            for name, case_sums, control_sums, q, q2 in observed:
+                if methods[c] == "monte-carlo" and n == 0:
+                    p = p2 = np.nan
+                elif methods[c] == "monte-carlo":
+                    p = (_exceedances(null_vals, q[c]) + 1) / (len(null_vals) + 1)
+                    p2 = (_exceedances(null_vals2, q2[c]) + 1) / (len(null_vals2) + 1)
+                elif methods[c] == "exact":
+                    p = weights[support_vals >= q[c]].sum()
+                    p2 = weights[support_vals2 >= q2[c]].sum()
+                elif np.isnan(q2[c]):
+                    p = p2 = np.nan
+                else:
+                    p = np.nan
+                    p2 = normal_tail_vals2(case_col, control_col, k, case_sums[c], control_sums[c])
+                results.append((name, k, frequency, methods[c], q[c], p if not np.isnan(q[c]) else np.nan,
+                                q2[c], p2 if not np.isnan(q2[c]) else np.nan, n))
+    table = pd.DataFrame(results, columns=["gene_set", "k", "frequency", "null", "q", "p", "q2", "p2", "n"])
+    for column in ["p", "p2"]:
+        table[column + "_fdr"] = table.groupby("frequency")[column].transform(benjamini_hochberg)
+    return table.sort_values(["gene_set", "frequency"], kind="stable").reset_index(drop=True)
 
 
 def validate_file(arg):
@@ -120,20 +1029,87 @@ if __name__ == "__main__":
     analyse = subparsers.add_parser("Analyse", help="Find the Monte Carlo permutation values for a given input.")
     analyse.add_argument("--input1", "-i", type=validate_file, help="Input file path", required=True)
     analyse.add_argument("--input2", "-i2", type=validate_file, help="Input file path", required=True)
-    analyse.add_argument("--out", "-", type=validate_file, help="Output file path", required=False)
-    analyse.add_argument("--iterations", "-n", type=int, help="Total permutation iterations to be ran. ")
+    analyse.add_argument("--out", "-o", type=Path, help="Output TSV path, printed to stdout if not given.")
+    analyse.add_argument("--iterations", "-n", type=int, default=50000,
+                         help="Total permutation iterations to be ran. ")
+    analyse.add_argument("--seed", "-s", type=int, help="Seed of the permutation random generator.")
+    analyse.add_argument("--engine", choices=["vectorized", "loop"], default="vectorized",
+                         help="Permutation engine, loop is the slow per-iteration pandas reference.")
+    analyse.add_argument("--workers", "-w", type=int, default=1,
+                         help="Worker processes for the vectorized engine. Results do not depend on it.")
+    analyse.add_argument("--keep-values", action="store_true",
+                         help="Keep every permutation value in memory instead of only the running summaries.")
+    analyse.add_argument("--bins", type=int, default=200, help="Histogram bins of the null distribution plots.")
+    analyse.add_argument("--plot", type=Path,
+                         help="Render the null distributions to this image file (e.g. out.png). Not drawn otherwise.")
+    analyse.add_argument("--sequential", action="store_true",
+                         help="Stop permuting a column once its p-value is settled with respect to --alpha, "
+                              "--iterations becomes the per column maximum. Runs in a single process, "
+                              "cannot be combined with --workers.")
+    analyse.add_argument("--alpha", type=float, default=0.05, help="Significance level for --sequential.")
+    analyse.add_argument("--confidence", type=float, default=0.99,
+                         help="Confidence level of the p-value interval for --sequential.")
+    analyse.add_argument("--no-cache", action="store_true",
+                         help="Parse the input TSVs instead of using or writing their <input>.cache/ directory.")
+    analyse.add_argument("--null", choices=["auto", "exact", "monte-carlo"], default="auto",
+                         help="Null distribution: auto uses the exact null where it is cheaper than sampling and "
+                              "the normal approximation of p2 (p is left empty) for sets of at least 100 genes "
+                              "whose exact null is too large, exact forces an analytic null (normal approximation "
+                              "for large sets).")
+    analyse.add_argument("--case-samples", type=int, default=CASE_SAMPLES,
+                         help="Number of samples in the case cohort (-i2), normalizes the q2 ratio.")
+    analyse.add_argument("--control-samples", type=int, default=CONTROL_SAMPLES,
+                         help="Number of samples in the control cohort (-i), normalizes the q2 ratio.")
+    screen = subparsers.add_parser("Screen", help="Test every gene set of a GMT/TSV file against the frequency "
+                                                  "tables, sharing one permutation bank per gene set size.")
+    screen.add_argument("--input1", "-i", type=validate_file, help="Control frequency table", required=True)
+    screen.add_argument("--input2", "-i2", type=validate_file, help="Case frequency table", required=True)
+    screen.add_argument("--gene-sets", "-g", type=validate_file, required=True,
+                        help="Gene sets as GMT (.gmt) or two column TSV (set name, gene) file.")
+    screen.add_argument("--out", "-o", type=Path, help="Output TSV path, printed to stdout if not given.")
+    screen.add_argument("--iterations", "-n", type=int, default=50000, help="Permutations per gene set size.")
+    screen.add_argument("--seed", "-s", type=int, help="Seed of the permutation random generator.")
+    screen.add_argument("--workers", "-w", type=int, default=1, help="Worker processes.")
+    screen.add_argument("--no-cache", action="store_true", help="See Analyse --no-cache.")
+    screen.add_argument("--null", choices=["auto", "exact", "monte-carlo"], default="auto",
+                        help="Null distribution, see Analyse --null.")
+    screen.add_argument("--case-samples", type=int, default=CASE_SAMPLES, help="See Analyse --case-samples.")
+    screen.add_argument("--control-samples", type=int, default=CONTROL_SAMPLES,
+                        help="See Analyse --control-samples.")
     start = datetime.datetime.now()
     args = parser.parse_args()
+    if args.command is None:
+        parser.print_usage()
+        sys.exit(1)
+    if str.lower(args.command) == "analyse" and args.sequential and args.workers > 1:
+        parser.error("--sequential runs in a single process, --workers {0} would be ignored".format(args.workers))
     # gene_list = []
-    normal_df = pd.read_csv(args.input1, sep="\t", header=0)
-    rv_df = pd.read_csv(args.input2, sep="\t", header=0)
-    outlines = []
-    if args.out is None and len(outlines) > 0:
-        filename = str(uuid.uuid4())
-        with open(filename, "w+") as out:
-            out.write()
-        sys.stderr.write("Created output file {0}.".format(filename))
-
-    permutation_analysis(pd.DataFrame(rv_genes), rv_df, normal_df)
+    normal_df = load_frequency_table(args.input1, not args.no_cache)
+    rv_df = load_frequency_table(args.input2, not args.no_cache)
+    if str.lower(args.command) == "screen":
+        test = PermutationTest.from_tables(rv_df, normal_df, args.case_samples, args.control_samples)
+        table = screen_gene_sets(read_gene_sets(args.gene_sets), test, args.iterations, args.seed,
+                                 args.workers, args.null)
+        if args.out is not None:
+            table.to_csv(args.out, sep="\t", index=False)
+            sys.stderr.write("Wrote {0} gene set results to {1}\n".format(len(table), args.out))
+        else:
+            print(table.to_csv(sep="\t", index=False))
+    else:
+        result = permutation_analysis(rv_genes, rv_df, normal_df, args.iterations, args.seed, args.engine,
+                                      args.workers, args.keep_values, args.bins, args.sequential, args.alpha,
+                                      args.confidence, args.null,
+                                      case_samples=args.case_samples, control_samples=args.control_samples)
+        if args.keep_values:
+            print(result.accumulator.value_frames()[0])
+        table = result.summary()
+        if args.out is not None:
+            table.to_csv(args.out, sep="\t", index_label="frequency")
+            sys.stderr.write("Wrote {0} frequency column results to {1}\n".format(len(table), args.out))
+        else:
+            print(table.to_csv(sep="\t", index_label="frequency"))
+        if args.plot is not None:
+            plot_analysis(result, args.plot)
+            sys.stderr.write("Wrote the null distribution plots to {0}\n".format(args.plot))
     end = datetime.datetime.now()
     print("Time: {0}".format(end - start))
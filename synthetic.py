@@ -0,0 +1,278 @@
+import argparse
+import hashlib
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# GRCh37 autosome and X lengths, contigs are named chr<name> like the sequencing VCFs (see vcfs_to_matrixtable)
+GRCH37_LENGTHS = {
+    "1": 249250621, "2": 243199373, "3": 198022430, "4": 191154276, "5": 180915260, "6": 171115067,
+    "7": 159138663, "8": 146364022, "9": 141213431, "10": 135534747, "11": 135006516, "12": 133851895,
+    "13": 115169878, "14": 107349540, "15": 102531392, "16": 90354753, "17": 81195210, "18": 78077248,
+    "19": 59128983, "20": 63025520, "21": 48129895, "22": 51304566, "X": 155270560}
+# Synthetic genes are consecutive windows of this many bases, SYN<contig>_<window>
+GENE_SPAN = 100000
+# VEP impacts and how often the stub VEP assigns them
+IMPACT_WEIGHTS = {"MODIFIER": 0.6, "LOW": 0.2, "MODERATE": 0.15, "HIGH": 0.05}
+# Share of the sites without a MAX_AF
+MISSING_AF = 0.1
+# CSQ fields of vep_settings.json, in order
+CSQ_FIELDS = ["IMPACT", "SYMBOL", "HGNC_ID", "MAX_AF", "MAX_AF_POPS"]
+POPULATIONS = ["gnomAD_AFR", "gnomAD_AMR", "gnomAD_EAS", "gnomAD_NFE", "gnomAD_SAS"]
+# Frequency table bins of main.af_bin_names(main.AF_BIN_EDGES)
+AF_BINS = ["gnomad_1", "gnomad_1_5", "gnomad_5_100", "gnomad_NA"]
+BASES = "ACGT"
+# Rows of write_edge_case_vcf on chrX from EDGE_START on, every EDGE_STEP bases: alleles, FORMAT and the sample
+# entry. They cover the entries main.append_table and local_engine handle specially.
+EDGE_START = 1000000
+EDGE_STEP = 10
+EDGE_ROWS = [
+    ("A", "C", "GT:AD:DP", "0/1:5,5:0"),  # DP 0, AD[1] / DP is inf and counted
+    ("A", "C", "GT:AD:DP", "0/1:0,0:0"),  # 0 / 0 is nan, left out
+    ("A", "C", "GT:AD:DP", "./.:3,7:10"),  # Missing call
+    ("A", "C", "GT:AD:DP", "0/1:.:10"),  # Missing AD
+    ("A", "C", "GT:AD:DP", "0/1:3,7:."),  # Missing DP
+    ("A", "C", "GT", "0/1"),  # No AD and DP
+    ("A", "C", "GT:AD:DP", "0/0:10,0:10"),  # No alternative allele
+    ("A", "C", "GT:AD:DP", "1|1:0,10:10"),  # Phased
+    ("A", "C", "GT:AD:DP", "0/1:7,3:10"),  # Variant fraction exactly 0.3, counted
+    ("A", "C", "GT:AD:DP", "0/1:8,2:10"),  # Variant fraction below 0.3
+    ("A", "C,G", "GT:AD:DP", "1/2:2,4,4:10"),  # Multi allelic, AC 2 and the variant fraction of the first alt
+    ("A", "*", "GT:AD:DP", "0/1:3,7:10"),  # Star allele, skipped
+    ("A", "C", "GT:AD:DP", "0/1:3,7:10"),  # MAX_AF on the 0.01 edge, see EDGE_ANNOTATIONS
+    ("A", "C", "GT:AD:DP", "0/1:3,7:10"),  # MAX_AF on the 0.05 edge
+    ("A", "C", "GT:AD:DP", "0/1:3,7:10"),  # Empty SYMBOL and MAX_AF
+]
+# CSQ fields of the edge case sites that site_annotation does not draw from the hash, by (contig, pos, ref, alt)
+EDGE_ANNOTATIONS = {
+    ("X", EDGE_START + 12 * EDGE_STEP, "A", "C"): ["MODERATE", "SYNX_EDGE", "100001", "0.01", "gnomAD_NFE"],
+    ("X", EDGE_START + 13 * EDGE_STEP, "A", "C"): ["HIGH", "SYNX_EDGE", "100001", "0.05", "gnomAD_AFR"],
+    ("X", EDGE_START + 14 * EDGE_STEP, "A", "C"): ["LOW", "", "", "", ""]}
+# Entries both engines must refuse to import, each written alone by write_edge_case_vcf(path, sample, failing)
+FAILING_ROWS = {
+    "one_element_ad": ("A", "C", "GT:AD:DP", "0/1:7:10"),  # AD without an alternative depth
+    "missing_ad_element": ("A", "C", "GT:AD:DP", "0/1:3,.:10"),  # Rejected by array_elements_required=True
+}
+
+
+def gene_symbol(contig, pos):
+    return "SYN{0}_{1}".format(contig, pos // GENE_SPAN)
+
+
+def site_annotation(contig, pos, ref, alt):
+    """
+    CSQ annotation of a site, a function of the site alone so that the stub VEP and the generated VCFs agree
+    without sharing state: the gene is the GENE_SPAN window of the position, the impact and MAX_AF are drawn from
+    a hash of the site.
+    :return: list of the CSQ_FIELDS values
+    """
+    contig = contig[3:] if contig.startswith("chr") else contig
+    if (contig, pos, ref, alt) in EDGE_ANNOTATIONS:
+        return list(EDGE_ANNOTATIONS[(contig, pos, ref, alt)])
+    digest = hashlib.blake2b("{0}:{1}:{2}:{3}".format(contig, pos, ref, alt).encode("utf-8"), digest_size=12).digest()
+    u = [int.from_bytes(digest[i:i + 4], "little") / 2 ** 32 for i in (0, 4, 8)]
+    impact, cumulative = list(IMPACT_WEIGHTS)[-1], 0
+    for name, weight in IMPACT_WEIGHTS.items():
+        cumulative += weight
+        if u[0] < cumulative:
+            impact = name
+            break
+    symbol = gene_symbol(contig, pos)
+    hgnc_id = str(100000 + (sum(map(ord, contig)) * 40000 + pos // GENE_SPAN) % 900000)
+    if u[1] < MISSING_AF:
+        max_af, populations = "", ""
+    else:
+        # Log uniform between 1e-5 and 0.5, most sites are rare
+        max_af = "{0:.6g}".format(10 ** (-5 + u[2] * np.log10(0.5 / 1e-5)))
+        populations = POPULATIONS[int(u[1] * 1e6) % len(POPULATIONS)]
+    return [impact, symbol, hgnc_id, max_af, populations]
+
+
+def csq_header():
+    return "##INFO=<ID=CSQ,Number=.,Type=String,Description=\"Consequence annotations from Ensembl VEP. " \
+           "Format: {0}\">".format("|".join(CSQ_FIELDS))
+
+
+def cohort_sites(rng, variants, genes):
+    """
+    Distinct variant sites of a synthetic cohort, spread over genes windows picked at random along GRCh37.
+    :param variants: Number of sites
+    :param genes: Number of genes the sites fall in
+    :return: list of (contig, pos, ref, alt, frequency) sorted by contig and position, frequency is the share of
+    samples carrying the site
+    """
+    contigs = list(GRCH37_LENGTHS)
+    lengths = np.array([GRCH37_LENGTHS[contig] for contig in contigs], dtype=float)
+    windows = set()
+    while len(windows) < genes:
+        c = rng.choice(len(contigs), p=lengths / lengths.sum())
+        windows.add((c, int(rng.integers(0, GRCH37_LENGTHS[contigs[c]] // GENE_SPAN))))
+    windows = sorted(windows)
+    sites = dict()
+    while len(sites) < variants:
+        c, window = windows[rng.integers(len(windows))]
+        pos = window * GENE_SPAN + int(rng.integers(1, GENE_SPAN))
+        if pos <= GRCH37_LENGTHS[contigs[c]] and (c, pos) not in sites:
+            ref = BASES[rng.integers(4)]
+            alt = BASES[(BASES.index(ref) + rng.integers(1, 4)) % 4]
+            # Most sites are private or rare in the cohort, a few are common
+            sites[(c, pos)] = (contigs[c], pos, ref, alt, float(min(0.9, rng.beta(0.3, 6))))
+    return [sites[key] for key in sorted(sites)]
+
+
+def _write_header(f, sample, csq=True):
+    f.write("##fileformat=VCFv4.2\n##reference=GRCh37\n")
+    for contig, length in GRCH37_LENGTHS.items():
+        f.write("##contig=<ID=chr{0},length={1},assembly=GRCh37>\n".format(contig, length))
+    f.write("##INFO=<ID=AC,Number=A,Type=Integer,Description=\"Allele count in genotypes\">\n")
+    if csq:
+        f.write(csq_header() + "\n")
+    f.write("##FORMAT=<ID=GT,Number=1,Type=String,Description=\"Genotype\">\n"
+            "##FORMAT=<ID=AD,Number=R,Type=Integer,Description=\"Allelic depths for the ref and alt alleles\">\n"
+            "##FORMAT=<ID=DP,Number=1,Type=Integer,Description=\"Approximate read depth\">\n")
+    f.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{0}\n".format(sample))
+
+
+def write_vcf(path, sample, sites, rng, csq=True):
+    """
+    Writes a single sample VCF of the sites with GT:AD:DP entries, mostly heterozygous with some low variant
+    fraction calls for the append_table filter. With csq the INFO column holds the CSQ annotation of a VEP
+    annotated VCF.
+    """
+    with open(path, "w") as f:
+        _write_header(f, sample, csq)
+        for contig, pos, ref, alt, frequency in sites:
+            hom = rng.random() < frequency / 2
+            dp = int(rng.integers(10, 200))
+            fraction = 1.0 if hom else (rng.uniform(0.05, 0.3) if rng.random() < 0.05 else rng.uniform(0.3, 0.7))
+            alt_depth = max(1, int(round(dp * fraction)))
+            info = "AC={0}".format(2 if hom else 1)
+            if csq:
+                info += ";CSQ=" + "|".join(site_annotation(contig, pos, ref, alt))
+            f.write("chr{0}\t{1}\t.\t{2}\t{3}\t50\tPASS\t{4}\tGT:AD:DP\t{5}:{6},{7}:{8}\n".format(
+                contig, pos, ref, alt, info, "1/1" if hom else "0/1", dp - alt_depth, alt_depth, dp))
+
+
+def write_cohort(directory, samples, variants=20000, sample_variants=2000, genes=500, seed=0, csq=True):
+    """
+    Writes samples synthetic single sample VCFs (SYN<number>.vcf) drawn from one cohort of sites, the same
+    arguments give the same files.
+    :param variants: Distinct sites of the cohort
+    :param sample_variants: Sites per sample, drawn by their cohort frequency
+    :param genes: Genes the sites fall in
+    :return: list of VCF Paths
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    sites = cohort_sites(rng, variants, genes)
+    weights = np.array([site[4] for site in sites])
+    weights /= weights.sum()
+    paths = []
+    for s in range(samples):
+        chosen = np.sort(rng.choice(len(sites), size=min(sample_variants, len(sites)), replace=False, p=weights))
+        path = directory.joinpath("SYN{0:06d}.vcf".format(s))
+        write_vcf(path, "SYN{0:06d}".format(s), [sites[i] for i in chosen], rng, csq)
+        paths.append(path)
+    return paths
+
+
+def write_edge_case_vcf(path, sample="EDGE000000", failing=None):
+    """
+    Writes a single sample VCF of the EDGE_ROWS entries, annotated as the stub VEP annotates them, for comparing
+    Readvcfs --engine local with the Hail path.
+    :param failing: Name of a FAILING_ROWS entry to write alone instead, which both engines fail on
+    :return: path
+    """
+    rows = EDGE_ROWS if failing is None else [FAILING_ROWS[failing]]
+    with open(path, "w") as f:
+        _write_header(f, sample)
+        for i, (ref, alts, keys, entry) in enumerate(rows):
+            pos = EDGE_START + i * EDGE_STEP
+            csq = ",".join("|".join(site_annotation("X", pos, ref, alt)) for alt in alts.split(","))
+            f.write("chrX\t{0}\t.\t{1}\t{2}\t50\tPASS\tCSQ={3}\t{4}\t{5}\n".format(pos, ref, alts, csq, keys, entry))
+    return path
+
+
+def frequency_table(genes, samples, seed=0):
+    """
+    Synthetic gene level frequency table in the layout exported by main.py Readvcfs/Loaddb (gene, then
+    <impact>.<AF bin> allele counts), for the stats.py benchmarks without Hail.
+    :param genes: Number of genes, SYN0_<index>
+    :param samples: Cohort size the counts scale with
+    :return: DataFrame
+    """
+    rng = np.random.default_rng(seed)
+    columns = ["{0}.{1}".format(impact.lower(), af_bin) for impact in IMPACT_WEIGHTS for af_bin in AF_BINS]
+    # Rare bins hold fewer alleles, genes differ in length (and so in burden)
+    bin_scale = np.array([0.5, 0.1, 2.0, 0.3])
+    rates = np.outer(rng.lognormal(0, 1, genes), np.outer(list(IMPACT_WEIGHTS.values()), bin_scale).ravel())
+    df = pd.DataFrame(rng.poisson(rates * samples / 100), columns=columns)
+    df.insert(0, "gene", ["SYN0_{0}".format(g) for g in range(genes)])
+    return df
+
+
+def write_vep_config(path, schema_config=Path(__file__).with_name("vep_settings.json")):
+    """
+    Writes a Hail VEP config running the stub VEP of this module, with the CSQ schema of schema_config.
+    """
+    with open(schema_config) as f:
+        schema = json.load(f)["vep_json_schema"]
+    config = {"command": [sys.executable, Path(__file__).resolve().__str__(), "Vep", "__OUTPUT_FORMAT_FLAG__"],
+              "env": {}, "vep_json_schema": schema}
+    with open(path, "w") as f:
+        json.dump(config, f, indent=4)
+    return path
+
+
+def stub_vep(lines, out):
+    """
+    Offline VEP stand-in for hl.methods.vep(..., csq=True): reads a VCF and writes it back with the CSQ header and
+    the site_annotation of every site as its INFO, as vep --vcf --fields IMPACT,SYMBOL,HGNC_ID,MAX_AF,MAX_AF_POPS
+    would.
+    """
+    for line in lines:
+        if line.startswith("##"):
+            out.write(line)
+        elif line.startswith("#"):
+            out.write(csq_header() + "\n")
+            out.write(line)
+        elif line.strip():
+            fields = line.rstrip("\n").split("\t")
+            while len(fields) < 8:
+                fields.append(".")
+            fields[7] = "CSQ=" + ",".join("|".join(site_annotation(fields[0], int(fields[1]), fields[3], alt))
+                                          for alt in fields[4].split(","))
+            out.write("\t".join(fields) + "\n")
+    out.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="Synthetic GRCh37 cohorts and an offline VEP stand-in for benchmarks.")
+    subparsers = parser.add_subparsers(title="commands", dest="command")
+    vcfs = subparsers.add_parser("Vcfs", help="Write synthetic single sample VCFs.")
+    vcfs.add_argument("-o", "--out", help="Folder to write the VCFs to.", type=Path, required=True)
+    vcfs.add_argument("-s", "--samples", help="Number of samples.", type=int, default=10)
+    vcfs.add_argument("-v", "--variants", help="Distinct sites of the cohort.", type=int, default=20000)
+    vcfs.add_argument("--sample-variants", help="Sites per sample.", type=int, default=2000)
+    vcfs.add_argument("-g", "--genes", help="Genes the sites fall in.", type=int, default=500)
+    vcfs.add_argument("--seed", type=int, default=0)
+    vcfs.add_argument("--no-csq", help="Leave the CSQ annotation out of the VCFs.", action="store_true")
+    vep_config = subparsers.add_parser("VepConfig", help="Write a Hail VEP config running the stub VEP.")
+    vep_config.add_argument("-o", "--out", help="Config path.", type=Path, required=True)
+    # Run by Hail as the VEP command, VEP options (e.g. --vcf) are ignored
+    subparsers.add_parser("Vep", help="Stub VEP, annotates the VCF on stdin to stdout.")
+    args, unknown = parser.parse_known_args()
+    if args.command == "Vcfs":
+        paths = write_cohort(args.out, args.samples, args.variants, args.sample_variants, args.genes, args.seed,
+                             not args.no_csq)
+        sys.stderr.write("Wrote {0} VCF(s) to {1}\n".format(len(paths), args.out))
+    elif args.command == "VepConfig":
+        write_vep_config(args.out)
+    elif args.command == "Vep":
+        stub_vep(sys.stdin, sys.stdout)
+    else:
+        parser.print_usage()
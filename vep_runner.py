@@ -0,0 +1,172 @@
+import datetime
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+# Sites per VEP run
+VEP_CHUNK_SIZE = 10000
+# VEP processes run at once, and the --fork of each
+VEP_WORKERS = 4
+VEP_FORK = 4
+# Attempts of a failed chunk after the first
+VEP_RETRIES = 2
+# CSQ INFO value of a VEP --vcf output line, as hl.methods.vep(..., csq=True) reads it
+CSQ_PATTERN = re.compile(r"CSQ=([^;\t]+)")
+VCF_HEADER = "##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+
+
+class VepRunner():
+    """
+    Runs VEP over a file of distinct sites in chunks of chunk_size sites, with up to workers VEP processes (each
+    with --fork fork) at once instead of one VEP process per Hail partition. Every chunk is streamed through VEP
+    (--vcf, the output hl.methods.vep reads with csq=True) and its CSQ annotations are written to
+    <cache_dir>/chunk_<hash>.tsv, named by the VEP command and the chunk sites. A failed chunk is retried, and a
+    chunk already in the cache is not run again, so a run that failed only redoes its failed chunks.
+    """
+    def __init__(self, config, cache_dir, chunk_size=VEP_CHUNK_SIZE, workers=VEP_WORKERS, fork=VEP_FORK,
+                 retries=VEP_RETRIES):
+        """
+        :param config: Hail VEP config (see vep_settings.json), its command and env are used
+        :param cache_dir: Folder of the chunk results
+        """
+        with open(config) as f:
+            settings = json.load(f)
+        self.command = ["--vcf" if part == "__OUTPUT_FORMAT_FLAG__" else part for part in settings["command"]]
+        if fork > 1:
+            self.command += ["--fork", str(fork)]
+        self.env = dict(os.environ, **settings.get("env", dict()))
+        self.tag = hashlib.sha256(json.dumps(self.command).encode("utf-8")).hexdigest()
+        self.cache_dir = Path(cache_dir)
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.retries = retries
+
+    def sites_path(self):
+        """
+        :return: New path in the cache folder to write a sites file to, see run
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        handle, path = tempfile.mkstemp(prefix="sites_", suffix=".tsv", dir=self.cache_dir)
+        os.close(handle)
+        return path
+
+    def _chunks(self, path):
+        # Sites file lines (contig, position, ref, comma separated alts) in chunks, the header is skipped
+        chunk = []
+        with open(path) as f:
+            next(f, None)
+            for line in f:
+                if line.strip() != "":
+                    chunk.append(line.rstrip("\n").split("\t"))
+                    if len(chunk) == self.chunk_size:
+                        yield chunk
+                        chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    def chunk_path(self, chunk):
+        digest = hashlib.sha256(self.tag.encode("utf-8"))
+        for site in chunk:
+            digest.update("\t".join(site).encode("utf-8") + b"\n")
+        return self.cache_dir.joinpath("chunk_{0}.tsv".format(digest.hexdigest()[:32]))
+
+    def _run_vep(self, chunk, path):
+        """
+        Streams one chunk through VEP, writing contig, position, ref, alts and the comma separated CSQ annotations
+        of every annotated site to path (written under a temporary name and renamed once VEP succeeded).
+        :return: Number of annotated sites
+        """
+        tmp = path.with_name(path.name + ".tmp")
+        annotated = 0
+        # VEP's messages go to a file, a full stderr pipe would block it while its output is read
+        with tempfile.TemporaryFile("w+") as vcf, tempfile.TemporaryFile("w+") as log, tmp.open("w") as out:
+            vcf.write(VCF_HEADER)
+            for contig, position, ref, alts in chunk:
+                vcf.write("{0}\t{1}\t.\t{2}\t{3}\t.\t.\t.\n".format(contig, position, ref, alts))
+            vcf.seek(0)
+            process = subprocess.Popen(self.command, stdin=vcf, stdout=subprocess.PIPE, stderr=log,
+                                       env=self.env, universal_newlines=True)
+            for line in process.stdout:
+                if line.startswith("#"):
+                    continue
+                columns = line.rstrip("\n").split("\t")
+                match = CSQ_PATTERN.search(columns[7]) if len(columns) > 7 else None
+                if match is not None:
+                    out.write("\t".join(columns[0:2] + columns[3:5] + [match.group(1)]) + "\n")
+                    annotated += 1
+            if process.wait() != 0:
+                log.seek(0)
+                raise RuntimeError("VEP exited with {0}: {1}".format(process.returncode, log.read().strip()[-2000:]))
+        os.replace(tmp, path)
+        return annotated
+
+    def _run_chunk(self, index, chunk, path):
+        for attempt in range(self.retries + 1):
+            try:
+                start = datetime.datetime.now()
+                annotated = self._run_vep(chunk, path)
+                return annotated, (datetime.datetime.now() - start).total_seconds()
+            except (OSError, RuntimeError) as e:
+                sys.stderr.write("VEP chunk {0} failed (attempt {1} of {2}): {3}\n"
+                                 .format(index, attempt + 1, self.retries + 1, e))
+                if attempt == self.retries:
+                    raise
+
+    def run(self, path):
+        """
+        Annotates the sites file path (tab separated contig, position, ref and comma separated alts with a header
+        line, e.g. exported by Hail), reporting the throughput as the chunks finish. At most twice workers chunks
+        are held in memory.
+        :return: list of the chunk result Paths, in the order of the sites
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        start = datetime.datetime.now()
+        paths, pending, failed = [], dict(), []
+        counts = {"sites": 0, "cached": 0}
+
+        def finish(done):
+            for future in done:
+                index, size = pending.pop(future)
+                try:
+                    annotated, seconds = future.result()
+                except (OSError, RuntimeError):
+                    failed.append(index)
+                    continue
+                counts["sites"] += size
+                elapsed = (datetime.datetime.now() - start).total_seconds()
+                sys.stderr.write("VEP chunk {0}: {1} site(s), {2} annotated in {3:.1f} s, {4:.0f} variants/s "
+                                 "overall\n".format(index, size, annotated, seconds,
+                                                    counts["sites"] / elapsed if elapsed > 0 else 0))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for index, chunk in enumerate(self._chunks(path)):
+                chunk_path = self.chunk_path(chunk)
+                paths.append(chunk_path)
+                if chunk_path.exists():
+                    counts["cached"] += 1
+                    continue
+                if len(pending) >= 2 * self.workers:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    finish(done)
+                pending[pool.submit(self._run_chunk, index, chunk, chunk_path)] = (index, len(chunk))
+            while len(pending) > 0:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                finish(done)
+        elapsed = (datetime.datetime.now() - start).total_seconds()
+        sys.stderr.write("VEP ran over {0} site(s) in {1:.1f} s ({2:.0f} variants/s), {3} of {4} chunk(s) were "
+                         "cached\n".format(counts["sites"], elapsed, counts["sites"] / elapsed if elapsed > 0 else 0,
+                                           counts["cached"], len(paths)))
+        if len(failed) > 0:
+            raise RuntimeError("VEP failed on chunk(s) {0} of {1}, the other chunks are cached in {2}, run again to "
+                               "retry".format(sorted(failed), path, self.cache_dir))
+        return paths
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)